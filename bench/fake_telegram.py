@@ -0,0 +1,174 @@
+"""
+Локальная замена Telegram Bot API для нагрузочных тестов.
+
+Реализует sendMessage, editMessageText, getChatMember, getMe и
+answerCallbackQuery с настраиваемой задержкой и долей ответов 429,
+а также getUpdates для проверки режима long polling.
+
+Запуск отдельно:
+    python bench/fake_telegram.py --port 8081 --latency 0.05 --error-rate 0.01
+"""
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+BOT_USER = {"id": 100000, "is_bot": True, "first_name": "Truth or Dare", "username": "truth_or_dare_bot"}
+
+
+class FakeTelegramServer:
+    """HTTP-сервер, отвечающий как Bot API. Считает вызовы по методам."""
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, retry_after=1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.errors = Counter()
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        # Обновления для getUpdates; подтверждёнными считаются те, что ниже offset следующего запроса
+        self._updates = []
+        self._updates_cond = threading.Condition()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_port
+
+    @property
+    def api_url(self):
+        """Шаблон для telebot.apihelper.API_URL."""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/bot{{0}}/{{1}}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-telegram", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls.clear()
+            self.errors.clear()
+
+    def push_updates(self, updates):
+        """Добавляет обновления, которые бот заберёт через getUpdates."""
+        with self._updates_cond:
+            self._updates.extend(updates)
+            self._updates_cond.notify_all()
+
+    def unconfirmed_updates(self):
+        with self._updates_cond:
+            return len(self._updates)
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', 100))
+        deadline = time.monotonic() + float(params.get('timeout', 0))
+        with self._updates_cond:
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._updates_cond.wait(deadline - time.monotonic())
+                self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            return self._updates[:limit]
+
+    def total_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def handle(self, method, params):
+        """Возвращает (HTTP-код, JSON-ответ) для вызова метода."""
+        if method == 'getUpdates':
+            return 200, {"ok": True, "result": self._get_updates(params)}
+        if method in ('deleteWebhook', 'setWebhook'):
+            return 200, {"ok": True, "result": True}
+        with self._lock:
+            self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and method != 'getMe' and random.random() < self.error_rate:
+            with self._lock:
+                self.errors[method] += 1
+            return 429, {"ok": False, "error_code": 429,
+                         "description": f"Too Many Requests: retry after {self.retry_after}",
+                         "parameters": {"retry_after": self.retry_after}}
+
+        if method == 'getMe':
+            result = BOT_USER
+        elif method == 'getChatMember':
+            user_id = int(params.get('user_id', 0))
+            result = {"status": "member",
+                      "user": {"id": user_id, "is_bot": False, "first_name": f"Игрок {user_id}"}}
+        elif method in ('sendMessage', 'editMessageText'):
+            chat_id = int(params.get('chat_id', 0))
+            message_id = int(params['message_id']) if 'message_id' in params else next(self._message_ids)
+            result = {"message_id": message_id, "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+                      "from": BOT_USER, "text": params.get('text', '')}
+        elif method == 'answerCallbackQuery':
+            result = True
+        else:
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found: method not found"}
+        return 200, {"ok": True, "result": result}
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Заголовки и тело пишутся отдельно: без этого ответ ждёт отложенного ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                path, _, query = self.path.partition('?')
+                length = int(self.headers.get('content-length') or 0)
+                body = self.rfile.read(length).decode('utf-8') if length else ''
+                params = {key: values[0] for key, values in parse_qs(body or query).items()}
+                status, payload = server.handle(path.rsplit('/', 1)[-1], params)
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_POST = do_GET
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная замена Telegram Bot API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help="задержка ответа, секунды")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument('--retry-after', type=int, default=1)
+    args = parser.parse_args()
+
+    server = FakeTelegramServer(args.host, args.port, args.latency, args.error_rate, args.retry_after).start()
+    print(f"Фейковый Bot API слушает {server.api_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
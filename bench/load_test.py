@@ -0,0 +1,236 @@
+"""
+Нагрузочный тест бота без обращения к настоящему Telegram.
+
+Поднимает локальный фейковый Bot API, подключает к нему main.py и
+проигрывает синтетические обновления через /webhook для тысяч
+одновременных SOLO- и DUO-игр. Печатает задержку вебхука (p50/p95/p99),
+пропускную способность, число исходящих вызовов на ход и память на сессию.
+С --transport polling те же обновления отдаются боту через getUpdates
+(polling_runner.py), и пропускная способность меряется так же.
+
+Запуск из корня репозитория:
+    python bench/load_test.py --solo 1000 --duo 1000 --turns 5
+    python bench/load_test.py --transport polling
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.fake_telegram import FakeTelegramServer  # noqa: E402
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class LoadTest:
+    """Проигрывает игры раундами: в каждом раунде по одному обновлению на игру."""
+
+    def __init__(self, main, server, solo, duo, turns, runner=None):
+        self.main = main
+        self.server = server
+        self.runner = runner
+        self.client = main.app.test_client()
+        self.solo_chats = [100000 + i for i in range(solo)]
+        self.duo_chats = [-100000 - i for i in range(duo)]
+        self.turns = turns
+        self.latencies = []
+        self.updates = 0
+        self.busy_seconds = 0.0
+        self._update_id = 0
+        self._theme_id = main.callback_router.theme_id(sorted(main.theme_store.get())[0])
+
+    # --- Синтетические обновления ---
+    def _next_update_id(self):
+        self._update_id += 1
+        return self._update_id
+
+    @staticmethod
+    def _user(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"Игрок {user_id}"}
+
+    @staticmethod
+    def _chat(chat_id):
+        return {"id": chat_id, "type": "group" if chat_id < 0 else "private"}
+
+    def message(self, chat_id, user_id, text):
+        message = {"message_id": 1, "date": int(time.time()), "chat": self._chat(chat_id),
+                   "from": self._user(user_id), "text": text}
+        if text.startswith('/'):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        return {"update_id": self._next_update_id(), "message": message}
+
+    def callback(self, chat_id, user_id, data):
+        update_id = self._next_update_id()
+        return {"update_id": update_id,
+                "callback_query": {"id": str(update_id), "chat_instance": str(chat_id), "data": data,
+                                   "from": self._user(user_id),
+                                   "message": {"message_id": 1, "date": int(time.time()),
+                                               "chat": self._chat(chat_id), "text": ""}}}
+
+    # --- Отправка и ожидание ---
+    def post(self, update):
+        body = json.dumps(update)
+        started = time.perf_counter()
+        response = self.client.post('/webhook', data=body, content_type='application/json')
+        self.latencies.append(time.perf_counter() - started)
+        if response.status_code != 200:
+            raise RuntimeError(f"/webhook ответил {response.status_code}")
+        self.updates += 1
+
+    def wait_idle(self):
+        """Ждёт, пока очередь обновлений и очередь исходящих запросов опустеют."""
+        if self.runner is not None:
+            # Обновление подтверждено, когда бот запросил getUpdates со следующим offset
+            while self.server.unconfirmed_updates():
+                time.sleep(0.001)
+            queue = self.runner.queue
+        else:
+            queue = getattr(self.main, 'update_queue', None)
+        api = self.main.api
+        while (queue is not None and queue.depth) or getattr(api, 'pending', 0):
+            time.sleep(0.001)
+
+    def round(self, updates):
+        started = time.perf_counter()
+        if self.runner is not None:
+            self.server.push_updates(updates)
+            self.updates += len(updates)
+        else:
+            for update in updates:
+                self.post(update)
+        self.wait_idle()
+        self.busy_seconds += time.perf_counter() - started
+
+    # --- Сценарии ---
+    def start_games(self):
+        encode = self.main.callback_router.encode
+        solo = self.solo_chats
+        duo = self.duo_chats
+        self.round([self.message(c, c, '/start') for c in solo] +
+                   [self.message(c, -c, '/duo') for c in duo])
+        self.round([self.callback(c, c, encode('solo_start')) for c in solo] +
+                   [self.callback(c, -c + 1, encode('join_duo', -c)) for c in duo])
+        self.round([self.callback(c, c, encode('theme', self._theme_id)) for c in solo + duo])
+
+    def play_turns(self):
+        encode = self.main.callback_router.encode
+        for turn in range(self.turns):
+            command = '/truth' if turn % 2 == 0 else '/dare'
+            route = 'truth' if turn % 2 == 0 else 'dare'
+            sessions = {c: self.main.get_session(c) for c in self.duo_chats}
+            self.round([self.message(c, c, command) for c in self.solo_chats] +
+                       [self.callback(c, s.turn, encode(route, s.turn)) for c, s in sessions.items()])
+            others = {c: [p for p in s.players if p != s.turn][0] for c, s in sessions.items()}
+            self.round([self.callback(c, other, encode('enough', other)) for c, other in others.items()])
+
+    def end_games(self):
+        self.round([self.message(c, abs(c), '/end') for c in self.solo_chats + self.duo_chats])
+
+    def run(self):
+        self.start_games()
+        games = len(self.solo_chats) + len(self.duo_chats)
+        session_stats = self.main.sessions.stats()
+
+        self.server.reset_counters()
+        turn_updates = self.updates
+        turn_seconds = self.busy_seconds
+        self.play_turns()
+        turn_updates = self.updates - turn_updates
+        turn_seconds = self.busy_seconds - turn_seconds
+        # SOLO-ход — одно сообщение, DUO-ход — выбор задания и «Достаточно»
+        turns = self.turns * games
+        outbound = self.server.total_calls()
+
+        self.end_games()
+        return {
+            "transport": "polling" if self.runner is not None else "webhook",
+            "games": games,
+            "updates": self.updates,
+            "webhook_p50_ms": percentile(self.latencies, 0.50) * 1000,
+            "webhook_p95_ms": percentile(self.latencies, 0.95) * 1000,
+            "webhook_p99_ms": percentile(self.latencies, 0.99) * 1000,
+            "updates_per_second": self.updates / self.busy_seconds if self.busy_seconds else 0.0,
+            "turn_updates_per_second": turn_updates / turn_seconds if turn_seconds else 0.0,
+            "outbound_calls_per_turn": outbound / turns if turns else 0.0,
+            "outbound_calls": dict(self.server.calls),
+            "injected_429": sum(self.server.errors.values()),
+            "sessions": session_stats["sessions"],
+            "bytes_per_session": session_stats["approx_bytes"] / session_stats["sessions"]
+            if session_stats["sessions"] else 0.0,
+        }
+
+
+def import_main(server):
+    """Импортирует main.py, направив telebot на фейковый сервер."""
+    os.environ.setdefault('BOT_TOKEN', '123456:bench')
+    # Лимиты Telegram в тесте только мешают измерять сам бот
+    os.environ.setdefault('OUTBOUND_GLOBAL_RATE', '1000000')
+    # Состояние развёртывания не трогаем: снимок (read_snapshot удаляет файл), сессии
+    # из общего хранилища и кэш/пакет тем исказили бы замеры и испортили бы рабочие файлы
+    os.environ.update(SNAPSHOT_PATH='', SESSION_BACKEND='memory', THEME_CACHE_PATH='', THEME_PACK_PATH='')
+    from telebot import apihelper
+    apihelper.API_URL = server.api_url
+    import main
+    return main
+
+
+def print_report(report):
+    print(f"Транспорт: {report['transport']}, игр: {report['games']}, обновлений: {report['updates']}")
+    if report['transport'] == 'webhook':
+        print(f"Задержка вебхука: p50 {report['webhook_p50_ms']:.3f} мс, "
+              f"p95 {report['webhook_p95_ms']:.3f} мс, p99 {report['webhook_p99_ms']:.3f} мс")
+    print(f"Обновлений в секунду: {report['updates_per_second']:.0f} "
+          f"(на ходах: {report['turn_updates_per_second']:.0f})")
+    print(f"Исходящих вызовов на ход: {report['outbound_calls_per_turn']:.2f} {report['outbound_calls']}")
+    print(f"Ответов 429: {report['injected_429']}")
+    print(f"Память на сессию: {report['bytes_per_session']:.0f} байт ({report['sessions']} сессий)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на фейковом Bot API")
+    parser.add_argument('--solo', type=int, default=1000, help="число SOLO-игр")
+    parser.add_argument('--duo', type=int, default=1000, help="число DUO-игр")
+    parser.add_argument('--turns', type=int, default=5, help="ходов в каждой игре")
+    parser.add_argument('--latency', type=float, default=0.0, help="задержка фейкового API, секунды")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument('--transport', choices=('webhook', 'polling'), default='webhook')
+    parser.add_argument('--json', help="записать отчёт в JSON-файл для сравнения между запусками")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    server = FakeTelegramServer(latency=args.latency, error_rate=args.error_rate).start()
+    runner = None
+    try:
+        main_module = import_main(server)
+        if args.transport == 'polling':
+            import polling_runner
+            # Короткий long polling, чтобы тест не ждал в конце
+            os.environ.setdefault('POLLING_TIMEOUT', '1')
+            runner = polling_runner.create_runner()
+            threading.Thread(target=runner.run_forever, name="polling", daemon=True).start()
+        report = LoadTest(main_module, server, args.solo, args.duo, args.turns, runner).run()
+    finally:
+        if runner is not None:
+            runner.stop()
+        server.stop()
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import logging
+
+from telebot import types
+
+
+class BotInfo:
+    """
+    Кэш профиля самого бота.
+
+    id бота известен из токена (часть до двоеточия), поэтому проверки
+    «это сам бот?» не требуют запросов. Полный профиль (get_me)
+    загружается при старте и перезапрашивается, только если прошлая
+    попытка не удалась.
+    """
+
+    def __init__(self, api, token):
+        self.api = api
+        self._id = int(token.split(':', 1)[0]) if token and ':' in token else None
+        self._me = None
+
+    @property
+    def id(self):
+        if self._id is None:
+            me = self.me()
+            return me.id if me else None
+        return self._id
+
+    def me(self):
+        """Профиль бота; при неудаче возвращает None, и следующий вызов попробует снова."""
+        if self._me is None:
+            try:
+                me = self.api.get_me()
+            except Exception:
+                logging.error("Не удалось получить профиль бота.", exc_info=True)
+                return None
+            self._me = me
+            self._id = me.id
+        return self._me
+
+    def dump(self):
+        """Профиль бота для снимка состояния."""
+        return {"me": self._me.to_dict() if self._me is not None else None}
+
+    def load(self, data):
+        """Восстанавливает профиль из снимка: после этого me() не обращается к API."""
+        if data.get("me") and self._me is None:
+            self._me = types.User.de_json(data["me"])
+            self._id = self._me.id
+
+    def is_me(self, user_id):
+        return user_id == self.id
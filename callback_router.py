@@ -0,0 +1,118 @@
+import logging
+import time
+import zlib
+from collections import namedtuple
+
+# Разобранный callback_data: имя маршрута и аргумент (id игрока, тема или None)
+CallbackAction = namedtuple('CallbackAction', ['route', 'arg'])
+
+# Версия компактного формата: "<версия><код маршрута>[:<аргумент>]", например "1t:12345"
+ENCODING_VERSION = '1'
+# Ограничение Telegram на длину callback_data
+MAX_CALLBACK_DATA = 64
+
+ROUTE_CODES = {
+    'solo_start': 's',
+    'duo_start_invite': 'i',
+    'join_duo': 'j',
+    'theme': 'h',
+    'no_theme': 'n',
+    'truth': 't',
+    'dare': 'd',
+    'enough': 'e',
+}
+ROUTES_BY_CODE = {code: route for route, code in ROUTE_CODES.items()}
+
+# Маршруты, аргумент которых — id пользователя
+INT_ARG_ROUTES = frozenset(('join_duo', 'truth', 'dare', 'enough'))
+
+# Старый формат кнопок, которые могли остаться в уже отправленных сообщениях
+LEGACY_PREFIXES = {
+    'solo_start': 'solo_start',
+    'duo_start_invite': 'duo_start_invite',
+    'no_theme': 'no_theme',
+    'join_duo': 'join_duo',
+    'theme': 'theme',
+    'truth_self': 'truth',
+    'dare_self': 'dare',
+    'enough': 'enough',
+}
+
+
+def theme_id(theme_name):
+    """Короткий стабильный идентификатор темы: название может не уместиться в 64 байта."""
+    return format(zlib.crc32(theme_name.encode('utf-8')), 'x')
+
+
+def encode(route, arg=None):
+    data = ENCODING_VERSION + ROUTE_CODES[route]
+    if arg is not None:
+        data += f':{arg}'
+    if len(data.encode('utf-8')) > MAX_CALLBACK_DATA:
+        raise ValueError(f"callback_data длиннее {MAX_CALLBACK_DATA} байт: {data}")
+    return data
+
+
+def parse(data):
+    """Разбирает callback_data в CallbackAction. Возвращает None для неизвестных данных."""
+    if not data:
+        return None
+    prefix, _, arg = data.partition(':')
+    if prefix[:1] == ENCODING_VERSION and len(prefix) == 2:
+        route = ROUTES_BY_CODE.get(prefix[1])
+    else:
+        route = LEGACY_PREFIXES.get(prefix)
+        # В старом формате тема передавалась названием, а не идентификатором
+        if route == 'theme':
+            return CallbackAction('theme_name', arg)
+    if route is None:
+        return None
+    if route in INT_ARG_ROUTES:
+        try:
+            return CallbackAction(route, int(arg))
+        except ValueError:
+            return None
+    return CallbackAction(route, arg or None)
+
+
+class CallbackRouter:
+    """
+    Таблица обработчиков callback-запросов: callback_data разбирается
+    один раз, а обработчик находится одним поиском в словаре.
+    Время обработки каждого маршрута пишется в metrics (bot_callback_seconds).
+    """
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+        self._routes = {}
+
+    def route(self, *routes):
+        """Декоратор: регистрирует обработчик handler(call, action) для маршрутов."""
+        def decorator(handler):
+            for route in routes:
+                self._routes[route] = handler
+            return handler
+        return decorator
+
+    def dispatch(self, call):
+        """Вызывает обработчик для call. Возвращает False, если маршрут неизвестен."""
+        action = parse(call.data)
+        handler = self._routes.get(action.route) if action else None
+        if handler is None:
+            logging.warning("Неизвестные данные кнопки: %r", call.data, extra={"event": "callback"})
+            if self.metrics is not None:
+                self.metrics.inc('bot_callback_unknown_total')
+            return False
+
+        if self.metrics is None:
+            handler(call, action)
+            return True
+        started = time.perf_counter()
+        try:
+            handler(call, action)
+        except Exception:
+            self.metrics.inc('bot_callback_errors_total', route=action.route)
+            raise
+        finally:
+            self.metrics.observe('bot_callback_seconds', time.perf_counter() - started, route=action.route)
+        return True
@@ -0,0 +1,64 @@
+import logging
+import sys
+import time
+
+from task_deck import TaskDeck
+
+
+class GameSession:
+    __slots__ = ('mode', 'players', 'chat_id', 'turn', 'last_task', 'game_active', 'theme', 'last_active', 'decks', 'filters')
+
+    def __init__(self, mode, players, chat_id):
+        self.mode = mode
+        self.players = players
+        self.chat_id = chat_id
+        self.turn = None
+        self.last_task = None
+        self.game_active = True
+        self.theme = None
+        self.last_active = time.time()
+        # Колоды заданий по ключу (тема, тип)
+        self.decks = {}
+        # Фильтры заданий по тегам: 'tag' — только с тегом, '!tag' — без него
+        self.filters = ()
+        logging.info("Создана новая игровая сессия в чате %s в режиме %s с игроками %s.", chat_id, mode, players,
+                     extra={"event": "session"})
+
+    def to_dict(self):
+        """Представление сессии для хранения во внешнем хранилище."""
+        return {
+            "mode": self.mode,
+            "players": self.players,
+            "chat_id": self.chat_id,
+            "turn": self.turn,
+            "last_task": self.last_task,
+            "game_active": self.game_active,
+            "theme": self.theme,
+            "decks": [[theme, task_type, deck.to_list()] for (theme, task_type), deck in self.decks.items()],
+            "filters": list(self.filters),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        session = cls.__new__(cls)
+        session.mode = data["mode"]
+        session.players = data["players"]
+        session.chat_id = data["chat_id"]
+        session.turn = data["turn"]
+        session.last_task = data["last_task"]
+        session.game_active = data["game_active"]
+        session.theme = data["theme"]
+        session.last_active = time.time()
+        session.decks = {(theme, task_type): TaskDeck.from_list(deck)
+                         for theme, task_type, deck in data.get("decks", ())}
+        session.filters = tuple(data.get("filters", ()))
+        return session
+
+    def approx_size(self):
+        """Приблизительный объём памяти, занимаемый сессией, в байтах."""
+        size = sys.getsizeof(self) + sys.getsizeof(self.players) + sys.getsizeof(self.decks)
+        size += sum(deck.approx_size() for deck in self.decks.values())
+        for value in (self.last_task, self.theme):
+            if value is not None:
+                size += sys.getsizeof(value)
+        return size
@@ -0,0 +1,71 @@
+import os
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from telebot import apihelper
+from urllib3.util.retry import Retry
+
+
+class PooledTransport:
+    """
+    HTTP-транспорт для запросов к Bot API с пулом keep-alive соединений.
+
+    Подключается к telebot через apihelper.CUSTOM_REQUEST_SENDER: все
+    потоки используют одну сессию requests, поэтому TLS-рукопожатие
+    выполняется один раз на соединение, а не на каждый вызов. Ошибки
+    соединения повторяются с экспоненциальной задержкой, ответы
+    502/503/504 — только для чтений (GET: getMe, getChat, getChatMember):
+    POST вроде sendMessage мог выполниться до ошибки шлюза, и повтор
+    отправил бы сообщение дважды. 429 обрабатывает очередь исходящих
+    запросов (outbound.py).
+    Время каждого HTTP-вызова пишется в metrics (bot_http_seconds).
+    """
+
+    def __init__(self, pool_connections=4, pool_maxsize=32, retries=3, backoff=0.3,
+                 connect_timeout=5, read_timeout=30, session=None, metrics=None):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.metrics = metrics
+        self.session = session if session is not None else requests.Session()
+        # Повторяем только то, что безопасно: запрос не дошёл, или шлюз Telegram
+        # недоступен при чтении — telebot шлёт GET только для методов без побочных эффектов
+        retry = Retry(total=retries, connect=retries, read=0, status=retries,
+                      status_forcelist=(502, 503, 504), allowed_methods=frozenset({'GET'}),
+                      backoff_factor=backoff, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+        for prefix in ('http://', 'https://'):
+            self.session.mount(prefix, adapter)
+
+    def install(self):
+        """Направляет все запросы telebot через этот транспорт."""
+        apihelper.CONNECT_TIMEOUT = self.connect_timeout
+        apihelper.READ_TIMEOUT = self.read_timeout
+        apihelper.CUSTOM_REQUEST_SENDER = self
+        return self
+
+    def __call__(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        started = time.perf_counter()
+        try:
+            return self.session.request(method, url, params=params, files=files,
+                                        timeout=timeout or (self.connect_timeout, self.read_timeout),
+                                        proxies=proxies)
+        except requests.RequestException as e:
+            if self.metrics is not None:
+                self.metrics.inc('bot_http_errors_total', method=url.rsplit('/', 1)[-1], error=type(e).__name__)
+            raise
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe('bot_http_seconds', time.perf_counter() - started,
+                                     method=url.rsplit('/', 1)[-1])
+
+
+def create_transport(metrics=None):
+    """Создаёт транспорт по переменным окружения HTTP_*."""
+    return PooledTransport(pool_connections=int(os.getenv('HTTP_POOL_CONNECTIONS', 4)),
+                           pool_maxsize=int(os.getenv('HTTP_POOL_SIZE', 32)),
+                           retries=int(os.getenv('HTTP_RETRIES', 3)),
+                           backoff=float(os.getenv('HTTP_BACKOFF', 0.3)),
+                           connect_timeout=float(os.getenv('HTTP_CONNECT_TIMEOUT', 5)),
+                           read_timeout=float(os.getenv('HTTP_READ_TIMEOUT', 30)),
+                           metrics=metrics)
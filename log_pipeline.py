@@ -0,0 +1,143 @@
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+# Поля записи, которые попадают в JSON, если заданы
+FIELDS = ('event', 'handler', 'chat_id', 'user_id', 'update_id', 'latency_ms')
+
+_context = contextvars.ContextVar('log_context', default={})
+_listener = None
+_records = None
+_output = None
+
+
+@contextmanager
+def log_context(**fields):
+    """Поля (chat_id, user_id, ...), которые добавляются ко всем записям внутри блока."""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """Дописывает в запись поля из log_context, не перетирая переданные через extra."""
+
+    def filter(self, record):
+        for key, value in _context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает только долю записей каждого события: rates = {event: доля}.
+    Предупреждения и ошибки не отбрасываются никогда.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(getattr(record, 'event', None))
+        return rate is None or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON."""
+
+    def format(self, record):
+        payload = {"ts": self.formatTime(record), "level": record.levelname, "message": record.getMessage()}
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                payload[field] = value
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler, который не форматирует запись в потоке запроса:
+    сообщение собирается из msg и args уже в потоке QueueListener.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def parse_sample_rates(value):
+    """'task=0.1,update=0.01' -> {'task': 0.1, 'update': 0.01}."""
+    rates = {}
+    for item in value.split(','):
+        if '=' in item:
+            event, rate = item.split('=', 1)
+            rates[event.strip()] = float(rate)
+    return rates
+
+
+def _start_listener():
+    global _listener
+    _listener = QueueListener(_records, _output, respect_handler_level=True)
+    _listener.start()
+
+
+def _stop_listener():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _after_fork():
+    # Поток слушателя не переживает fork: в дочернем процессе запускаем свой
+    global _listener
+    if _listener is not None:
+        _listener = None
+        _start_listener()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+atexit.register(_stop_listener)
+
+
+def setup_logging():
+    """
+    Настраивает корневой логгер по переменным окружения:
+    LOG_LEVEL — уровень (INFO);
+    LOG_FORMAT — text или json;
+    LOG_QUEUE=1 — запись и форматирование в фоновом потоке, обработчик только кладёт запись в очередь;
+    LOG_SAMPLE — доли записей по событиям, например 'task=0.1,update=0.01'.
+    """
+    global _records, _output
+    _stop_listener()
+    _output = logging.StreamHandler()
+    _output.setFormatter(JsonFormatter() if os.getenv('LOG_FORMAT', 'text') == 'json' else logging.Formatter(TEXT_FORMAT))
+
+    if os.getenv('LOG_QUEUE', '1') != '0':
+        _records = queue.SimpleQueue()
+        handler = DeferredQueueHandler(_records)
+        _start_listener()
+    else:
+        handler = _output
+    handler.addFilter(ContextFilter())
+    handler.addFilter(SamplingFilter(parse_sample_rates(os.getenv('LOG_SAMPLE', 'update=0.01'))))
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
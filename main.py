@@ -1,13 +1,32 @@
 import telebot
 from telebot import types
 import random
+import functools
 import logging
 import os
-from solo_mode import handle_solo_commands, get_solo_keyboard
-from flask import Flask, request, abort
+import json
+import time
+from solo_mode import handle_solo_commands, get_solo_keyboard, NO_TASKS_TEXT
+from update_queue import UpdateQueue, update_chat_id, update_user_id
+from log_pipeline import setup_logging, log_context
+from name_cache import NameCache, display_name
+from game_session import GameSession
+from session_store import create_session_store
+from task_deck import draw_task
+from theme_store import ThemeStore
+from outbound import OutboundDispatcher, DirectDispatcher
+from metrics import metrics
+from bot_info import BotInfo
+from update_dedupe import UpdateDeduplicator
+from http_transport import create_transport
+from warm_state import GracefulShutdown, read_snapshot, write_snapshot
+from response_builder import ResponseProxy
+import callback_router
+from flask import Flask, request, abort, jsonify
 
 # --- Настройка логирования ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Запись логов идёт в фоновом потоке, формат и выборка задаются через LOG_* (см. log_pipeline.py)
+setup_logging()
 
 # Инициализация Flask приложения
 app = Flask(__name__)
@@ -18,79 +37,81 @@ if not TOKEN:
     logging.error("Токен бота не найден в переменных окружения!")
     raise ValueError("Токен бота не найден. Установите переменную окружения TELEGRAM_BOT_TOKEN")
 
-bot = telebot.TeleBot(TOKEN)
+# Обработчики выполняются синхронно внутри потока, который разбирает обновление:
+# параллелизм и порядок внутри чата обеспечивает update_queue
+bot = telebot.TeleBot(TOKEN, threaded=False)
+
+# --- HTTP-транспорт ---
+# TELEGRAM_API_URL позволяет направить бота на другой сервер Bot API (например, bench/fake_telegram.py)
+if os.getenv('TELEGRAM_API_URL'):
+    telebot.apihelper.API_URL = os.getenv('TELEGRAM_API_URL')
+# HTTP_POOLED=1: один пул keep-alive соединений на процесс вместо сессий telebot по умолчанию
+if os.getenv('HTTP_POOLED', '1') != '0':
+    http_transport = create_transport(metrics).install()
+
+# --- Исходящие запросы ---
+# OUTBOUND_QUEUE=1: сообщения отправляются через очередь с соблюдением лимитов Telegram
+if os.getenv('OUTBOUND_QUEUE', '1') != '0':
+    dispatcher = OutboundDispatcher(bot,
+                                    global_rate=float(os.getenv('OUTBOUND_GLOBAL_RATE', 30)),
+                                    workers=int(os.getenv('OUTBOUND_WORKERS', 4)),
+                                    metrics=metrics)
+else:
+    dispatcher = DirectDispatcher(bot, metrics=metrics)
+# Ответы обработчиков одного обновления собираются и отправляются вместе после него:
+# ответ на кнопку первым, без очереди независимые вызовы идут параллельно
+api = ResponseProxy(dispatcher,
+                    concurrent=not isinstance(dispatcher, OutboundDispatcher),
+                    workers=int(os.getenv('RESPONSE_WORKERS', 8)))
+
+# Профиль бота: запрашивается один раз, а не на каждое событие
+bot_info = BotInfo(api, TOKEN)
+
+# --- Режим приёма вебхуков ---
+# WEBHOOK_ASYNC=1: вебхук только ставит обновление в очередь и сразу отвечает 200
+WEBHOOK_ASYNC = os.getenv('WEBHOOK_ASYNC', '1') != '0'
 
 # --- Динамическая загрузка вопросов и заданий из файлов ---
-def load_themes(directory='themes'):
-    """Загружает темы из файлов в указанной директории."""
-    themes = {}
-    if not os.path.exists(directory):
-        logging.warning(f"Директория '{directory}' не найдена. Создаю ее...")
-        os.makedirs(directory)
-        return themes
-
-    for filename in os.listdir(directory):
-        if filename.endswith('.txt'):
-            theme_name = os.path.splitext(filename)[0]
-            file_path = os.path.join(directory, filename)
-            current_section = None
-            truths = []
-            dares = []
-
-            with open(file_path, 'r', encoding='utf-8') as f:
-                for line in f:
-                    line = line.strip()
-                    if line == 'TRUTHS:':
-                        current_section = 'truths'
-                    elif line == 'DARES:':
-                        current_section = 'dares'
-                    elif line and not line.startswith('#'):
-                        if current_section == 'truths':
-                            truths.append(line)
-                        elif current_section == 'dares':
-                            dares.append(line)
-
-            if truths or dares:
-                themes[theme_name] = {"truths": truths, "dares": dares}
-                logging.info(f"Загружена тема '{theme_name}' из файла '{filename}'.")
-
-    return themes
-
-# Загружаем темы при запуске бота
-THEMES = load_themes()
+# Изменения в themes/*.txt подхватываются без перезапуска (проверка раз в THEME_POLL_INTERVAL секунд)
+# THEME_PACK_PATH: задания читаются из общего для всех воркеров пакета через mmap; пустое значение отключает
+theme_store = ThemeStore('themes',
+                         poll_interval=float(os.getenv('THEME_POLL_INTERVAL', 5)),
+                         cache_path=os.getenv('THEME_CACHE_PATH', '.themes.cache'),
+                         pack_path=os.getenv('THEME_PACK_PATH', 'themes.pack') or None)
 
 # --- Хранение состояний сессий ---
-sessions = {}
-
-class GameSession:
-    def __init__(self, mode, players, chat_id):
-        self.mode = mode
-        self.players = players
-        self.chat_id = chat_id
-        self.turn = None
-        self.last_task = None
-        self.game_active = True
-        self.theme = None
-        logging.info(f"Создана новая игровая сессия в чате {chat_id} в режиме {mode} с игроками {players}.")
+# SESSION_BACKEND=memory (по умолчанию) или sqlite — общее хранилище для нескольких воркеров
+sessions = create_session_store(metrics)
 
 # --- Вспомогательные функции ---
 def get_session(chat_id):
     return sessions.get(chat_id)
 
-def get_menu_keyboard():
+# --- Клавиатуры ---
+# Клавиатуры собираются один раз и хранятся уже сериализованными в JSON:
+# telebot передаёт строку в reply_markup как есть
+KEYBOARD_CACHE_SIZE = int(os.getenv('KEYBOARD_CACHE_SIZE', 1024))
+
+def _build_menu_keyboard():
     markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("Играть одному", callback_data='solo_start'))
-    markup.add(types.InlineKeyboardButton("Играть с другом", callback_data='duo_start_invite'))
-    return markup
+    markup.add(types.InlineKeyboardButton("Играть одному", callback_data=callback_router.encode('solo_start')))
+    markup.add(types.InlineKeyboardButton("Играть с другом", callback_data=callback_router.encode('duo_start_invite')))
+    return markup.to_json()
 
-def get_theme_keyboard():
+MENU_KEYBOARD = _build_menu_keyboard()
+REMOVE_KEYBOARD = types.ReplyKeyboardRemove().to_json()
+
+def get_menu_keyboard():
+    return MENU_KEYBOARD
+
+def _build_theme_keyboard(themes):
     markup = types.InlineKeyboardMarkup(row_width=1)
-    if not THEMES:
+    if not themes:
         logging.warning("Нет доступных тем. Проверьте директорию 'themes'.")
-        markup.add(types.InlineKeyboardButton("Темы не найдены", callback_data='no_theme'))
-        return markup
+        markup.add(types.InlineKeyboardButton("Темы не найдены", callback_data=callback_router.encode('no_theme')))
+        return markup.to_json()
         
-    theme_names = sorted(THEMES.keys())
+    theme_names = sorted(themes.keys())
     solo_theme_name = None
     for name in theme_names:
         if name.lower() == 'сольный режим':
@@ -102,119 +123,203 @@ def get_theme_keyboard():
         theme_names.append(solo_theme_name)
 
     for theme_name in theme_names:
-        markup.add(types.InlineKeyboardButton(theme_name.title(), callback_data=f'theme:{theme_name}'))
+        markup.add(types.InlineKeyboardButton(theme_name.title(), callback_data=callback_router.encode('theme', callback_router.theme_id(theme_name))))
+    return markup.to_json()
+
+# (версия набора тем, клавиатура) — пересобирается только при изменении тем
+_theme_keyboard = (None, None)
+
+def get_theme_keyboard():
+    global _theme_keyboard
+    version, themes = theme_store.snapshot()
+    cached_version, markup = _theme_keyboard
+    if cached_version != version:
+        markup = _build_theme_keyboard(themes)
+        _theme_keyboard = (version, markup)
     return markup
 
+# (версия набора тем, {идентификатор темы: название})
+_theme_ids = (None, {})
+
+def get_theme_by_id(theme_id):
+    global _theme_ids
+    version, themes = theme_store.snapshot()
+    cached_version, theme_ids = _theme_ids
+    if cached_version != version:
+        theme_ids = {callback_router.theme_id(name): name for name in themes}
+        _theme_ids = (version, theme_ids)
+    return theme_ids.get(theme_id)
+
+@functools.lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def get_join_duo_keyboard(user_id):
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("Присоединиться к игре", callback_data=callback_router.encode('join_duo', user_id)))
+    return markup.to_json()
+
+@functools.lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
 def get_truth_dare_inline_keyboard(user_id):
     markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("Правда", callback_data=f'truth_self:{user_id}'),
-               types.InlineKeyboardButton("Действие", callback_data=f'dare_self:{user_id}'))
-    return markup
+    markup.add(types.InlineKeyboardButton("Правда", callback_data=callback_router.encode('truth', user_id)),
+               types.InlineKeyboardButton("Действие", callback_data=callback_router.encode('dare', user_id)))
+    return markup.to_json()
 
+@functools.lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
 def get_enough_inline_keyboard(user_id):
     markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("Достаточно", callback_data=f'enough:{user_id}'))
-    return markup
+    markup.add(types.InlineKeyboardButton("Достаточно", callback_data=callback_router.encode('enough', user_id)))
+    return markup.to_json()
+
+# Кэш имён игроков: наполняется из входящих обновлений, поэтому запросы к API нужны редко
+name_cache = NameCache(max_size=int(os.getenv('NAME_CACHE_SIZE', 10000)),
+                       ttl=int(os.getenv('NAME_CACHE_TTL', 3600)),
+                       metrics=metrics)
 
 def get_user_name(user_id, chat_id=None):
+    name = name_cache.get(chat_id, user_id)
+    if name:
+        return name
     try:
-        user = bot.get_chat_member(chat_id, user_id).user if chat_id else bot.get_chat(user_id)
-        return user.first_name if user.first_name else user.username
+        user = api.get_chat_member(chat_id, user_id).user if chat_id else api.get_chat(user_id)
+        name = display_name(user)
+        name_cache.put(chat_id, user_id, name)
+        return name
     except Exception:
-        logging.error(f"Не удалось получить имя пользователя с ID {user_id}.", exc_info=True)
+        logging.error("Не удалось получить имя пользователя с ID %s.", user_id, exc_info=True,
+                      extra={"event": "user_name"})
         return "Игрок"
 
 # --- Обработчики команд ---
 @bot.message_handler(commands=['start'])
+@metrics.timed('bot_handler', handler='start')
 def handle_start(message):
     chat_id = message.chat.id
     user_id = message.from_user.id
-    logging.info(f"Получена команда /start от пользователя {user_id} в чате {chat_id}.")
+    logging.info("Получена команда /start от пользователя %s в чате %s.", user_id, chat_id,
+                 extra={"event": "command", "handler": "start"})
     
     session = get_session(chat_id)
     if session and session.game_active:
-        bot.send_message(chat_id, "Уже идёт игра! Завершите её командой /end.", reply_markup=types.ReplyKeyboardRemove())
+        api.send_message(chat_id, "Уже идёт игра! Завершите её командой /end.", reply_markup=REMOVE_KEYBOARD)
         return
 
-    bot.send_message(chat_id, "Привет! Выбери режим игры:", reply_markup=get_menu_keyboard())
+    api.send_message(chat_id, "Привет! Выбери режим игры:", reply_markup=get_menu_keyboard())
 
 @bot.message_handler(commands=['duo'])
+@metrics.timed('bot_handler', handler='duo')
 def handle_duo_command(message):
     chat_id = message.chat.id
     user_id = message.from_user.id
-    logging.info(f"Получена команда /duo от пользователя {user_id} в чате {chat_id}.")
+    logging.info("Получена команда /duo от пользователя %s в чате %s.", user_id, chat_id,
+                 extra={"event": "command", "handler": "duo"})
     
     if message.chat.type not in ['group', 'supergroup']:
-        bot.send_message(chat_id, "Чтобы играть с другом, нужно создать групповой чат и добавить меня туда.")
+        api.send_message(chat_id, "Чтобы играть с другом, нужно создать групповой чат и добавить меня туда.")
         return
         
     session = get_session(chat_id)
     if session and session.game_active:
-        bot.send_message(chat_id, "В этом чате уже идёт игра! Завершите её командой /end.")
+        api.send_message(chat_id, "В этом чате уже идёт игра! Завершите её командой /end.")
         return
     
-    markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("Присоединиться к игре", callback_data=f'join_duo:{user_id}'))
-    
+    markup = get_join_duo_keyboard(user_id)
+
     player_name = get_user_name(user_id, chat_id)
-    bot.send_message(chat_id, f"**{player_name}** приглашает в игру «Правда или Действие»! Нажмите кнопку, чтобы присоединиться.",
+    api.send_message(chat_id, f"**{player_name}** приглашает в игру «Правда или Действие»! Нажмите кнопку, чтобы присоединиться.",
                      parse_mode="Markdown", reply_markup=markup)
-    bot.send_message(chat_id, f"Отлично, **{player_name}**! Теперь твой друг должен нажать на кнопку, чтобы начать игру.", parse_mode="Markdown")
+    api.send_message(chat_id, f"Отлично, **{player_name}**! Теперь твой друг должен нажать на кнопку, чтобы начать игру.", parse_mode="Markdown")
 
 @bot.message_handler(commands=['end'])
+@metrics.timed('bot_handler', handler='end')
 def handle_end(message):
     chat_id = message.chat.id
     user_id = message.from_user.id
     session = get_session(chat_id)
-    logging.info(f"Получена команда /end от пользователя {user_id} в чате {chat_id}.")
+    logging.info("Получена команда /end от пользователя %s в чате %s.", user_id, chat_id,
+                 extra={"event": "command", "handler": "end"})
     
     if session and session.game_active:
         session.game_active = False
         sessions.pop(chat_id, None)
-        logging.info(f"Игра в чате {chat_id} завершена.")
-        bot.send_message(chat_id, "Игра завершена.", reply_markup=types.ReplyKeyboardRemove())
+        logging.info("Игра в чате %s завершена.", chat_id, extra={"event": "game_end", "handler": "end"})
+        api.send_message(chat_id, "Игра завершена.", reply_markup=REMOVE_KEYBOARD)
     else:
-        bot.send_message(chat_id, "Нет активной игры. Начните новую с /start.", reply_markup=types.ReplyKeyboardRemove())
+        api.send_message(chat_id, "Нет активной игры. Начните новую с /start.", reply_markup=REMOVE_KEYBOARD)
 
 @bot.message_handler(commands=['rule'])
+@metrics.timed('bot_handler', handler='rule')
 def handle_rule_command(message):
     try:
         with open('rules.txt', 'r', encoding='utf-8') as f:
-            bot.send_message(message.chat.id, f.read())
+            api.send_message(message.chat.id, f.read())
     except Exception as e:
-        logging.error(f"Ошибка чтения правил: {e}")
-        bot.send_message(message.chat.id, "Правила временно недоступны. Попробуйте позже.")
+        logging.error("Ошибка чтения правил: %s", e, extra={"event": "rules", "handler": "rule"})
+        api.send_message(message.chat.id, "Правила временно недоступны. Попробуйте позже.")
+
+@bot.message_handler(commands=['filter'])
+@metrics.timed('bot_handler', handler='filter')
+def handle_filter_command(message):
+    """/filter tag !tag — задания только с тегом tag и без тега tag; /filter без аргументов сбрасывает фильтр."""
+    chat_id = message.chat.id
+    session = get_session(chat_id)
+    if not session or not session.game_active:
+        api.send_message(chat_id, "Фильтр заданий можно задать только во время игры.")
+        return
+
+    filters = tuple(sorted({tag.lower() for tag in message.text.split()[1:]}))
+    theme = theme_store.get().get(session.theme) if session.theme else None
+    if filters and theme is not None and all(selector is None or selector.tags is None
+                                             for selector in theme["selectors"].values()):
+        # Без тегов draw_task фильтр не применяет, поэтому и сохранять его незачем
+        api.send_message(chat_id, f"У заданий темы '{session.theme.title()}' нет тегов, фильтровать нечего.")
+        return
+
+    session.filters = filters
+    sessions.save(session)
+    logging.info("В чате %s фильтр заданий: %s", chat_id, session.filters, extra={"event": "filter", "handler": "filter"})
+    if session.filters:
+        api.send_message(chat_id, f"Фильтр заданий: {' '.join(session.filters)}")
+    else:
+        api.send_message(chat_id, "Фильтр заданий сброшен.")
 
 @bot.message_handler(content_types=['new_chat_members'])
+@metrics.timed('bot_handler', handler='new_chat_members')
 def handle_new_chat_members(message):
     chat_id = message.chat.id
     new_members = message.new_chat_members
     
-    if bot.get_me() in new_members:
-        logging.info(f"Бот добавлен в чат {chat_id}. Запускаю автоматическое приглашение.")
+    if any(bot_info.is_me(member.id) for member in new_members):
+        logging.info("Бот добавлен в чат %s. Запускаю автоматическое приглашение.", chat_id,
+                     extra={"event": "bot_added", "handler": "new_chat_members"})
         
         session = get_session(chat_id)
         if session and session.game_active:
-            bot.send_message(chat_id, "В этом чате уже идёт игра! Завершите её командой /end.")
+            api.send_message(chat_id, "В этом чате уже идёт игра! Завершите её командой /end.")
             return
 
         initiator_id = message.from_user.id
         
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("Присоединиться к игре", callback_data=f'join_duo:{initiator_id}'))
-        
+        markup = get_join_duo_keyboard(initiator_id)
+
         player_name = get_user_name(initiator_id, chat_id)
-        bot.send_message(chat_id, 
+        api.send_message(chat_id, 
                          f"Привет! Спасибо, что добавил меня в чат.\n\n**{player_name}** приглашает в игру «Правда или Действие»! Нажмите кнопку, чтобы присоединиться.",
                          parse_mode="Markdown", 
                          reply_markup=markup)
 
 # --- Обработчики Callback-запросов ---
-@bot.callback_query_handler(func=lambda call: call.data == 'solo_start')
-def handle_callback_solo_start(call):
+# Все нажатия кнопок проходят через одну таблицу маршрутов вместо цепочки предикатов telebot
+callbacks = callback_router.CallbackRouter(metrics=metrics)
+
+@bot.callback_query_handler(func=lambda call: True)
+def handle_callback(call):
+    if not callbacks.dispatch(call):
+        api.answer_callback_query(call.id)
+
+@callbacks.route('solo_start')
+def handle_callback_solo_start(call, action):
     if call.message is None:
         logging.error("handle_callback_solo_start: call.message is None")
-        bot.answer_callback_query(call.id, "Произошла ошибка. Пожалуйста, попробуйте еще раз.")
+        api.answer_callback_query(call.id, "Произошла ошибка. Пожалуйста, попробуйте еще раз.")
         return
         
     chat_id = call.message.chat.id
@@ -222,75 +327,75 @@ def handle_callback_solo_start(call):
     
     session = get_session(chat_id)
     if session and session.game_active:
-        bot.answer_callback_query(call.id, "Уже идёт игра! Завершите её командой /end.")
+        api.answer_callback_query(call.id, "Уже идёт игра! Завершите её командой /end.")
         return
 
     sessions[chat_id] = GameSession('SOLO', [user_id], chat_id)
-    bot.edit_message_text("Началась игра в режиме SOLO! Выбери тему:", chat_id, call.message.message_id)
-    bot.send_message(chat_id, "Выбери тему:", reply_markup=get_theme_keyboard())
-    bot.answer_callback_query(call.id)
+    api.edit_message_text("Началась игра в режиме SOLO! Выбери тему:", chat_id, call.message.message_id)
+    api.send_message(chat_id, "Выбери тему:", reply_markup=get_theme_keyboard())
+    api.answer_callback_query(call.id)
 
-@bot.callback_query_handler(func=lambda call: call.data == 'duo_start_invite')
-def handle_callback_duo_start_invite(call):
+@callbacks.route('duo_start_invite')
+def handle_callback_duo_start_invite(call, action):
     if call.message is None:
         logging.error("handle_callback_duo_start_invite: call.message is None")
-        bot.answer_callback_query(call.id, "Произошла ошибка. Пожалуйста, попробуйте еще раз.")
+        api.answer_callback_query(call.id, "Произошла ошибка. Пожалуйста, попробуйте еще раз.")
         return
         
     chat_id = call.message.chat.id
     user_id = call.from_user.id
     
     if call.message.chat.type not in ['group', 'supergroup']:
-        bot.answer_callback_query(call.id, "Чтобы играть с другом, нужно создать групповой чат и добавить меня туда.")
+        api.answer_callback_query(call.id, "Чтобы играть с другом, нужно создать групповой чат и добавить меня туда.")
         return
 
     session = get_session(chat_id)
     if session and session.game_active:
-        bot.answer_callback_query(call.id, "В этом чате уже идёт игра! Завершите её командой /end.")
+        api.answer_callback_query(call.id, "В этом чате уже идёт игра! Завершите её командой /end.")
         return
 
-    markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("Присоединиться к игре", callback_data=f'join_duo:{user_id}'))
-    
+    markup = get_join_duo_keyboard(user_id)
+
     player_name = get_user_name(user_id, chat_id)
-    bot.edit_message_text(f"**{player_name}** приглашает в игру «Правда или Действие»! Нажмите кнопку, чтобы присоединиться.",
+    api.edit_message_text(f"**{player_name}** приглашает в игру «Правда или Действие»! Нажмите кнопку, чтобы присоединиться.",
                           chat_id, call.message.message_id, parse_mode="Markdown", reply_markup=markup)
-    bot.answer_callback_query(call.id, "Приглашение отправлено!")
+    api.answer_callback_query(call.id, "Приглашение отправлено!")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('join_duo'))
-def handle_callback_join_duo(call):
+@callbacks.route('join_duo')
+def handle_callback_join_duo(call, action):
     if call.message is None:
         logging.error("handle_callback_join_duo: call.message is None. Невозможно обработать.")
-        bot.answer_callback_query(call.id, "Произошла ошибка. Пожалуйста, попробуйте еще раз.")
+        api.answer_callback_query(call.id, "Произошла ошибка. Пожалуйста, попробуйте еще раз.")
         return
         
     chat_id = call.message.chat.id
     user_id = call.from_user.id
 
-    initiator_id = int(call.data.split(':')[1])
+    initiator_id = action.arg
     
     session = get_session(chat_id)
 
     if user_id == initiator_id:
-        bot.answer_callback_query(call.id, "Ты уже начал эту игру! Попроси друга нажать на кнопку, чтобы присоединиться.")
+        api.answer_callback_query(call.id, "Ты уже начал эту игру! Попроси друга нажать на кнопку, чтобы присоединиться.")
         return
     
     if not session or not session.game_active:
-        if bot.get_me().id == user_id:
-            bot.answer_callback_query(call.id, "Я не могу играть с тобой, я бот! Выбери другого игрока.")
+        if bot_info.is_me(user_id):
+            api.answer_callback_query(call.id, "Я не могу играть с тобой, я бот! Выбери другого игрока.")
             return
 
         sessions[chat_id] = GameSession('DUO', [initiator_id, user_id], chat_id)
         session = sessions[chat_id]
-        logging.info(f"Новая DUO-сессия создана в чате {chat_id} с игроками {initiator_id} и {user_id}.")
+        logging.info("Новая DUO-сессия создана в чате %s с игроками %s и %s.", chat_id, initiator_id, user_id,
+                     extra={"event": "game_start", "handler": "join_duo"})
 
-    bot.edit_message_text("Отлично! Выбери тему для игры:", chat_id, call.message.message_id, reply_markup=get_theme_keyboard())
-    bot.answer_callback_query(call.id, "Вы присоединились к игре!")
+    api.edit_message_text("Отлично! Выбери тему для игры:", chat_id, call.message.message_id, reply_markup=get_theme_keyboard())
+    api.answer_callback_query(call.id, "Вы присоединились к игре!")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('theme'))
-def handle_callback_theme(call):
+@callbacks.route('theme', 'theme_name')
+def handle_callback_theme(call, action):
     if call.message is None:
-        bot.answer_callback_query(call.id, "Произошла ошибка.")
+        api.answer_callback_query(call.id, "Произошла ошибка.")
         return
         
     chat_id = call.message.chat.id
@@ -298,20 +403,27 @@ def handle_callback_theme(call):
     
     session = get_session(chat_id)
     if not session or not session.game_active:
-        bot.answer_callback_query(call.id, "Игра не активна.")
+        api.answer_callback_query(call.id, "Игра не активна.")
         return
     
-    selected_theme = call.data.split(':')[1]
-    if selected_theme not in THEMES:
-        bot.answer_callback_query(call.id, "Выбранная тема не найдена.")
+    # Новые кнопки передают идентификатор темы, старые — её название
+    selected_theme = get_theme_by_id(action.arg) if action.route == 'theme' else action.arg
+    if selected_theme not in theme_store.get():
+        api.answer_callback_query(call.id, "Выбранная тема не найдена.")
+        return
+
+    # Повторное нажатие не должно заново бросать монетку в уже начатой игре
+    if session.mode == 'DUO' and session.turn is not None:
+        api.answer_callback_query(call.id, "Тема уже выбрана.")
         return
 
     session.theme = selected_theme
-    logging.info(f"В чате {chat_id} выбрана тема: {session.theme}")
+    sessions.save(session)
+    logging.info("В чате %s выбрана тема: %s", chat_id, session.theme, extra={"event": "theme", "handler": "theme"})
 
     if session.mode == 'SOLO':
-        bot.edit_message_text(f"Тема '{session.theme.title()}' выбрана. Выбирай:", chat_id, call.message.message_id)
-        bot.send_message(chat_id, "Выбирай:", reply_markup=get_solo_keyboard())
+        api.edit_message_text(f"Тема '{session.theme.title()}' выбрана. Выбирай:", chat_id, call.message.message_id)
+        api.send_message(chat_id, "Выбирай:", reply_markup=get_solo_keyboard())
     else:
         player1_name = get_user_name(session.players[0], chat_id)
         player2_name = get_user_name(session.players[1], chat_id)
@@ -326,123 +438,139 @@ def handle_callback_theme(call):
             session.turn = session.players[1]
             start_player_name = player2_name
         
+        sessions.save(session)
         coin_result = ' '.join(coins)
         
         message_text = (f"🎲 Бросаю монетку: {coin_result}\n"
                         f"→ начинает **{start_player_name}**.\n"
                         f"Тема '{session.theme.title()}' выбрана. **{start_player_name}**, правда или действие?")
         
-        bot.edit_message_text(message_text, chat_id, call.message.message_id, 
+        api.edit_message_text(message_text, chat_id, call.message.message_id, 
                               reply_markup=get_truth_dare_inline_keyboard(session.turn), 
                               parse_mode="Markdown")
 
-    bot.answer_callback_query(call.id)
+    api.answer_callback_query(call.id)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith(('truth_self', 'dare_self')))
-def handle_callback_truth_dare_self(call):
+@callbacks.route('truth', 'dare')
+def handle_callback_truth_dare_self(call, action):
     if call.message is None:
-        bot.answer_callback_query(call.id, "Произошла ошибка.")
+        api.answer_callback_query(call.id, "Произошла ошибка.")
         return
         
     chat_id = call.message.chat.id
     user_id = call.from_user.id
-    command_type, turn_user_id_str = call.data.split(':')
-    turn_user_id = int(turn_user_id_str)
+    turn_user_id = action.arg
 
     session = get_session(chat_id)
 
     if not session or not session.game_active or not session.theme:
-        bot.answer_callback_query(call.id, "Игра не активна или не выбрана тема.")
+        api.answer_callback_query(call.id, "Игра не активна или не выбрана тема.")
         return
     
     if user_id != turn_user_id:
-        bot.answer_callback_query(call.id, "Сейчас не твой ход, подожди.")
+        api.answer_callback_query(call.id, "Сейчас не твой ход, подожди.")
+        return
+
+    # Повторное нажатие не должно выдавать второе задание за тот же ход
+    if session.mode == 'DUO' and session.last_task:
+        api.answer_callback_query(call.id, "Задание уже выбрано.")
         return
 
-    task_type = command_type.split('_')[0]
+    task_type = action.route
     
-    questions = THEMES.get(session.theme)
+    questions = theme_store.get().get(session.theme)
     if questions:
         if task_type == 'truth':
-            task = random.choice(questions["truths"])
+            task = draw_task(session, "truths", questions)
+            if task is None:
+                api.answer_callback_query(call.id, NO_TASKS_TEXT, show_alert=True)
+                return
             session.last_task = task
+            sessions.save(session)
             
             other_player_id = [p for p in session.players if p != user_id][0] if session.mode == 'DUO' else None
             
             if session.mode == 'DUO':
-                bot.edit_message_text(f"**{get_user_name(user_id, chat_id)}**, ты выбрал правду.\nТвоё задание: {task}",
+                api.edit_message_text(f"**{get_user_name(user_id, chat_id)}**, ты выбрал правду.\nТвоё задание: {task}",
                                       chat_id, call.message.message_id, parse_mode="Markdown",
                                       reply_markup=get_enough_inline_keyboard(other_player_id))
             else:
-                bot.edit_message_text(f"**{get_user_name(user_id, chat_id)}**, ты выбрал правду.\nТвоё задание: {task}",
+                api.edit_message_text(f"**{get_user_name(user_id, chat_id)}**, ты выбрал правду.\nТвоё задание: {task}",
                                       chat_id, call.message.message_id, parse_mode="Markdown")
         else:
-            task = random.choice(questions["dares"])
+            task = draw_task(session, "dares", questions)
+            if task is None:
+                api.answer_callback_query(call.id, NO_TASKS_TEXT, show_alert=True)
+                return
             session.last_task = task
+            sessions.save(session)
             
             other_player_id = [p for p in session.players if p != user_id][0] if session.mode == 'DUO' else None
 
             if session.mode == 'DUO':
-                bot.edit_message_text(f"**{get_user_name(user_id, chat_id)}**, ты выбрал действие.\nТвоё задание: {task}",
+                api.edit_message_text(f"**{get_user_name(user_id, chat_id)}**, ты выбрал действие.\nТвоё задание: {task}",
                                       chat_id, call.message.message_id, parse_mode="Markdown",
                                       reply_markup=get_enough_inline_keyboard(other_player_id))
             else:
-                bot.edit_message_text(f"**{get_user_name(user_id, chat_id)}**, ты выбрал действие.\nТвоё задание: {task}",
+                api.edit_message_text(f"**{get_user_name(user_id, chat_id)}**, ты выбрал действие.\nТвоё задание: {task}",
                                       chat_id, call.message.message_id, parse_mode="Markdown")
         
-        logging.info(f"Ход игрока {user_id}. Выбрано {task_type}, задание: {task}.")
+        logging.info("Ход игрока %s. Выбрано %s, задание: %s.", user_id, task_type, task,
+                     extra={"event": "task", "handler": task_type})
     else:
-        logging.error(f"Тема '{session.theme}' не найдена.")
-        bot.answer_callback_query(call.id, "Произошла ошибка: выбранная тема не найдена.")
+        logging.error("Тема '%s' не найдена.", session.theme, extra={"event": "task", "handler": task_type})
+        api.answer_callback_query(call.id, "Произошла ошибка: выбранная тема не найдена.")
         
-    bot.answer_callback_query(call.id)
+    api.answer_callback_query(call.id)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('enough'))
-def handle_callback_enough(call):
+@callbacks.route('enough')
+def handle_callback_enough(call, action):
     if call.message is None:
-        bot.answer_callback_query(call.id, "Произошла ошибка.")
+        api.answer_callback_query(call.id, "Произошла ошибка.")
         return
     
     chat_id = call.message.chat.id
     user_id = call.from_user.id
-    turn_user_id_str = call.data.split(':')[1]
-    turn_user_id = int(turn_user_id_str)
+    turn_user_id = action.arg
     
     session = get_session(chat_id)
     
     if not session or not session.game_active:
-        bot.answer_callback_query(call.id, "Игра не активна.")
+        api.answer_callback_query(call.id, "Игра не активна.")
         return
     
     if user_id == session.turn:
-        bot.answer_callback_query(call.id, "Ты не можешь нажимать 'Достаточно' пока не выполнил задание!")
+        api.answer_callback_query(call.id, "Ты не можешь нажимать 'Достаточно' пока не выполнил задание!")
         return
         
     if user_id != turn_user_id:
-        bot.answer_callback_query(call.id, "Это кнопка для другого игрока.")
+        api.answer_callback_query(call.id, "Это кнопка для другого игрока.")
         return
         
     if not session.last_task:
-        bot.answer_callback_query(call.id, "Задание еще не было выбрано.")
+        api.answer_callback_query(call.id, "Задание еще не было выбрано.")
         return
 
     old_turn = session.turn
     session.turn = [p for p in session.players if p != old_turn][0]
     session.last_task = None
+    sessions.save(session)
     next_player_name = get_user_name(session.turn, chat_id)
     
-    logging.info(f"Задание выполнено. Ход переходит к игроку {session.turn}.")
+    logging.info("Задание выполнено. Ход переходит к игроку %s.", session.turn,
+                 extra={"event": "turn", "handler": "enough"})
     
-    bot.edit_message_text(f"Задание выполнено! Теперь ход игрока: **{next_player_name}**.", 
+    api.edit_message_text(f"Задание выполнено! Теперь ход игрока: **{next_player_name}**.", 
                           chat_id, call.message.message_id, parse_mode="Markdown")
 
-    bot.send_message(chat_id, f"**{next_player_name}**, правда или действие?",
+    api.send_message(chat_id, f"**{next_player_name}**, правда или действие?",
                      reply_markup=get_truth_dare_inline_keyboard(session.turn), parse_mode="Markdown")
                      
-    bot.answer_callback_query(call.id, "Ход переключен!")
+    api.answer_callback_query(call.id, "Ход переключен!")
 
 # --- Основной обработчик сообщений ---
 @bot.message_handler(func=lambda message: True)
+@metrics.timed('bot_handler', handler='all_messages')
 def handle_all_messages(message):
     chat_id = message.chat.id
     user_id = message.from_user.id
@@ -451,14 +579,14 @@ def handle_all_messages(message):
     
     if session and session.game_active:
         if session.mode == 'SOLO':
-            handle_solo_commands(bot, message, session, THEMES)
+            handle_solo_commands(api, message, session, theme_store.get())
         elif session.mode == 'DUO':
             if command == '/end':
                 handle_end(message)
             elif command in ['/truth', '/dare']:
-                bot.send_message(chat_id, "Пожалуйста, используйте кнопки 'Правда' или 'Действие' под сообщением.")
+                api.send_message(chat_id, "Пожалуйста, используйте кнопки 'Правда' или 'Действие' под сообщением.")
             else:
-                bot.send_message(chat_id, "Неизвестная команда. Используйте `/end` для завершения.")
+                api.send_message(chat_id, "Неизвестная команда. Используйте `/end` для завершения.")
     else:
         if command == '/start':
             handle_start(message)
@@ -467,11 +595,141 @@ def handle_all_messages(message):
         elif command == '/rule':
             handle_rule_command(message)
 
+# --- Обработка входящих обновлений ---
+def process_update(data, transport='webhook'):
+    """Разбирает JSON обновления и передаёт его обработчикам бота."""
+    started = time.perf_counter()
+    if isinstance(data, str):
+        data = json.loads(data)
+    update = types.Update.de_json(data)
+    name_cache.remember_update(update)
+    chat_id = update_chat_id(data)
+    with log_context(chat_id=chat_id, user_id=update_user_id(data), update_id=update.update_id):
+        with sessions.lock(chat_id), api.collect():
+            bot.process_new_updates([update])
+        elapsed = time.perf_counter() - started
+        logging.info("Обновление %s обработано за %.1f мс.", update.update_id, elapsed * 1000,
+                     extra={"event": "update", "latency_ms": round(elapsed * 1000, 3)})
+    metrics.observe('bot_update_seconds', elapsed, transport=transport)
+
+update_queue = UpdateQueue(process_update,
+                           workers=int(os.getenv('WEBHOOK_WORKERS', 4)),
+                           max_depth=int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000)),
+                           overflow=os.getenv('WEBHOOK_QUEUE_OVERFLOW', 'reject'))
+
+# Повторные доставки одного и того же обновления отбрасываются до обработчиков
+update_dedupe = UpdateDeduplicator(window=int(os.getenv('UPDATE_DEDUPE_WINDOW', 10000)),
+                                   shared=sessions if hasattr(sessions, 'remember_update_id') else None)
+
+def is_duplicate_update(data):
+    if update_dedupe.is_duplicate(data.get('update_id')):
+        logging.info("Повторная доставка обновления %s отброшена.", data.get('update_id'),
+                     extra={"event": "duplicate"})
+        metrics.inc('bot_duplicate_updates_total')
+        return True
+    return False
+
+# --- Снимок состояния и завершение работы ---
+# По SIGTERM вебхук перестаёт принимать обновления, очереди дообрабатываются, а сессии
+# и прогретые кэши пишутся в SNAPSHOT_PATH; при старте снимок восстанавливается
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', 'state.snapshot')
+# Очереди, которые нужно дообработать перед выходом (polling_runner.py добавляет свою)
+drain_queues = [update_queue]
+
+def snapshot_state():
+    state = {"names": name_cache.dump(), "bot": bot_info.dump(), "update_ids": update_dedupe.dump(), "sessions": []}
+    # Сессии из SQLite и так переживают перезапуск
+    if not sessions.persistent:
+        state["sessions"] = [[session.to_dict(), session.last_active] for session in sessions.values()]
+    return state
+
+def restore_state(state):
+    restored = sorted(state["sessions"], key=lambda item: item[1])
+    for data, last_active in restored:
+        session = GameSession.from_dict(data)
+        sessions[session.chat_id] = session
+        # Время простоя считается от последней активности до перезапуска
+        session.last_active = last_active
+    name_cache.load(state["names"])
+    bot_info.load(state["bot"])
+    update_dedupe.load(state["update_ids"])
+    logging.info("Состояние восстановлено из снимка: сессий %s, имён %s.", len(restored), len(state['names']),
+                 extra={"event": "restore"})
+
+def warm_caches():
+    """Заранее собирает клавиатуры и таблицы выбора заданий для идущих игр."""
+    get_theme_keyboard()
+    get_theme_by_id(None)
+    themes = theme_store.get()
+    for session in sessions.values():
+        if session.mode == 'DUO':
+            for player in session.players:
+                get_truth_dare_inline_keyboard(player)
+                get_enough_inline_keyboard(player)
+        theme = themes.get(session.theme)
+        if theme:
+            for selector in theme["selectors"].values():
+                if selector is not None:
+                    selector.table(session.filters)
+
+def drain_and_snapshot(timeout):
+    """Дообрабатывает очереди обновлений и исходящих запросов и пишет снимок состояния."""
+    deadline = time.monotonic() + timeout
+    for pending in drain_queues:
+        if not pending.drain(max(0.0, deadline - time.monotonic())):
+            logging.warning("Не все обновления успели обработаться до завершения.", extra={"event": "shutdown"})
+    if not dispatcher.drain(max(0.0, deadline - time.monotonic())):
+        logging.warning("Не все исходящие запросы успели отправиться до завершения.", extra={"event": "shutdown"})
+    sessions.flush()
+    if SNAPSHOT_PATH:
+        write_snapshot(SNAPSHOT_PATH, snapshot_state())
+        logging.info("Снимок состояния записан в '%s'.", SNAPSHOT_PATH, extra={"event": "snapshot"})
+
+if SNAPSHOT_PATH:
+    state = read_snapshot(SNAPSHOT_PATH, max_age=float(os.getenv('SNAPSHOT_MAX_AGE', 3600)))
+    if state:
+        restore_state(state)
+# Профиль бота запрашивается, только если его не было в снимке
+bot_info.me()
+warm_caches()
+
+shutdown = GracefulShutdown(drain_and_snapshot, timeout=float(os.getenv('SHUTDOWN_TIMEOUT', 20))).install()
+
 # --- Вебхук обработчики ---
 @app.route('/')
 def index():
     return "Бот 'Правда или Действие' работает!"
 
+@app.route('/stats')
+def stats():
+    """Текущие показатели процесса: сессии, память, вытеснения, очередь и кэш имён."""
+    return jsonify({
+        "sessions": sessions.stats(),
+        "update_queue_depth": update_queue.depth,
+        "name_cache": name_cache.stats(),
+    })
+
+def active_sessions_by_mode_and_theme():
+    # Хранилище ведёт счётчики само, сессии при каждом опросе не перебираются
+    return {(('mode', mode), ('theme', theme)): count for (mode, theme), count in sessions.counts().items()}
+
+metrics.describe('bot_handler_seconds', "Время обработки команд и сообщений")
+metrics.describe('bot_callback_seconds', "Время обработки нажатий кнопок по маршрутам")
+metrics.describe('bot_api_seconds', "Время вызовов Telegram Bot API по методам")
+metrics.describe('bot_update_seconds', "Полное время обработки одного обновления")
+metrics.describe('bot_webhook_seconds', "Время ответа эндпоинта /webhook")
+metrics.gauge('bot_update_queue_depth', lambda: update_queue.depth)
+metrics.gauge('bot_outbound_pending', lambda: getattr(api, 'pending', 0))
+metrics.describe('bot_session_evictions_total', "Сессии, удалённые по простою или лимиту SESSION_MAX")
+metrics.gauge('bot_active_sessions', active_sessions_by_mode_and_theme)
+metrics.describe('bot_name_cache_hits_total', "Имена игроков, найденные в кэше")
+metrics.describe('bot_name_cache_misses_total', "Имена игроков, которых не было в кэше")
+metrics.describe('bot_duplicate_updates_total', "Отброшенные повторные доставки обновлений")
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 @app.route('/set_webhook', methods=['GET', 'POST'])
 def set_webhook():
     webhook_url = os.getenv('WEBHOOK_URL')
@@ -487,11 +745,28 @@ def set_webhook():
         return "Ошибка установки вебхука", 500
 
 @app.route('/webhook', methods=['POST'])
+@metrics.timed('bot_webhook')
 def webhook():
+    if shutdown.stopping:
+        # Процесс завершается: Telegram повторит доставку уже новому процессу
+        return '', 503
     if request.headers.get('content-type') == 'application/json':
-        json_string = request.get_data().decode('utf-8')
-        update = types.Update.de_json(json_string)
-        bot.process_new_updates([update])
+        data = json.loads(request.get_data().decode('utf-8'))
+        if is_duplicate_update(data):
+            return '', 200
+        if not WEBHOOK_ASYNC:
+            try:
+                process_update(data)
+            except Exception:
+                # Telegram получит 500 и повторит доставку — она не должна считаться дубликатом
+                update_dedupe.forget(data.get('update_id'))
+                raise
+            return '', 200
+
+        if not update_queue.submit(update_chat_id(data), data):
+            # Очередь переполнена: Telegram повторит доставку позже
+            update_dedupe.forget(data.get('update_id'))
+            return '', 503
         return '', 200
     else:
         abort(403)
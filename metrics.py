@@ -0,0 +1,195 @@
+import bisect
+import functools
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+# Границы корзин гистограмм задержек, секунды
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Shard:
+    """Счётчики и гистограммы одного потока: пишет в них только этот поток."""
+
+    __slots__ = ('counters', 'histograms')
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def merge(self, other):
+        for key, value in list(other.counters.items()):
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, values in list(other.histograms.items()):
+            merged = self.histograms.get(key)
+            if merged is None:
+                self.histograms[key] = list(values)
+            else:
+                for i, value in enumerate(values):
+                    merged[i] += value
+
+
+class _Owner:
+    """Метка потока в threading.local: собирается сборщиком, когда поток завершается."""
+
+    __slots__ = ('__weakref__',)
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    """
+    Метрики в формате Prometheus.
+
+    Каждый поток пишет в свой шард без блокировок; шарды объединяются
+    только при чтении (render), поэтому измерения почти ничего не стоят
+    на горячем пути. Шард завершившегося потока вливается в общий
+    базовый шард, поэтому при потоке на запрос их число не растёт.
+    Значения датчиков (gauge) вычисляются функциями в момент чтения.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._local = threading.local()
+        self._shards = []
+        # Итоги потоков, которые уже завершились
+        self._base = _Shard()
+        self._lock = threading.Lock()
+        self._gauges = {}
+        self._help = {}
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = _Shard()
+            self._local.owner = owner = _Owner()
+            with self._lock:
+                self._shards.append(shard)
+            # Локальные данные потока удаляются при его завершении вместе с owner
+            weakref.finalize(owner, self._retire, shard)
+        return shard
+
+    def _retire(self, shard):
+        with self._lock:
+            self._base.merge(shard)
+            self._shards.remove(shard)
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        counters = self._shard().counters
+        key = (name, _labels_key(labels))
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        histograms = self._shard().histograms
+        key = (name, _labels_key(labels))
+        histogram = histograms.get(key)
+        if histogram is None:
+            # Счётчики корзин, затем сумма и количество
+            histogram = histograms[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def timed(self, name, **labels):
+        """Декоратор: измеряет время вызова функции и считает исключения."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                except Exception:
+                    self.inc(f'{name}_errors_total', **labels)
+                    raise
+                finally:
+                    self.observe(f'{name}_seconds', time.perf_counter() - started, **labels)
+            return wrapper
+        return decorator
+
+    def gauge(self, name, func):
+        """Регистрирует датчик: func() возвращает число или {метки: значение}."""
+        self._gauges[name] = func
+
+    def collect(self):
+        """Объединяет шарды: (счётчики, гистограммы)."""
+        total = _Shard()
+        # Под блокировкой: иначе шард, влитый в базовый во время чтения, учёлся бы дважды
+        with self._lock:
+            total.merge(self._base)
+            for shard in self._shards:
+                total.merge(shard)
+        return total.counters, total.histograms
+
+    def counter_value(self, name, **labels):
+        counters, _ = self.collect()
+        return counters.get((name, _labels_key(labels)), 0)
+
+    def render(self):
+        """Текст для эндпоинта /metrics."""
+        counters, histograms = self.collect()
+        lines = []
+
+        def header(name, kind):
+            if name in self._help:
+                lines.append(f'# HELP {name} {self._help[name]}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        previous = None
+        for (name, key), value in sorted(counters.items()):
+            if name != previous:
+                header(name, 'counter')
+                previous = name
+            lines.append(f'{name}{_format_labels(key)} {value}')
+
+        previous = None
+        for (name, key), values in sorted(histograms.items()):
+            if name != previous:
+                header(name, 'histogram')
+                previous = name
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), values):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{_format_labels(key, [("le", le)])} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(key)} {values[-2]}')
+            lines.append(f'{name}_count{_format_labels(key)} {values[-1]}')
+
+        for name, func in sorted(self._gauges.items()):
+            header(name, 'gauge')
+            value = func()
+            if isinstance(value, dict):
+                for labels, item in sorted(value.items()):
+                    lines.append(f'{name}{_format_labels(_labels_key(dict(labels)))} {item}')
+            else:
+                lines.append(f'{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+# Общий реестр метрик процесса
+metrics = Metrics()
@@ -0,0 +1,89 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+def display_name(user):
+    """Имя игрока для сообщений: first_name, а если его нет — username."""
+    return user.first_name if user.first_name else user.username
+
+
+class NameCache:
+    """
+    Потокобезопасный кэш имён игроков с ключом (chat_id, user_id).
+
+    Записи устаревают через ttl секунд, при превышении max_size
+    вытесняется самая давно использованная запись (LRU).
+    """
+
+    def __init__(self, max_size=10000, ttl=3600, metrics=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.metrics = metrics
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chat_id, user_id):
+        key = (chat_id, user_id)
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[1] <= now:
+                if item is not None:
+                    del self._items[key]
+                self.misses += 1
+                name = None
+            else:
+                self._items.move_to_end(key)
+                self.hits += 1
+                name = item[0]
+        if self.metrics is not None:
+            self.metrics.inc('bot_name_cache_misses_total' if name is None else 'bot_name_cache_hits_total')
+        return name
+
+    def put(self, chat_id, user_id, name):
+        if not name:
+            return
+        key = (chat_id, user_id)
+        with self._lock:
+            self._items[key] = (name, time.monotonic() + self.ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def remember(self, chat_id, user):
+        """Запоминает имя из объекта User, который уже пришёл в обновлении."""
+        if user is not None and not user.is_bot:
+            self.put(chat_id, user.id, display_name(user))
+
+    def remember_update(self, update):
+        """Наполняет кэш отправителями сообщений и нажатий кнопок из обновления."""
+        message = update.message or update.edited_message
+        if message is not None:
+            self.remember(message.chat.id, message.from_user)
+            for member in message.new_chat_members or ():
+                self.remember(message.chat.id, member)
+        callback = update.callback_query
+        if callback is not None and callback.message is not None:
+            self.remember(callback.message.chat.id, callback.from_user)
+
+    def dump(self):
+        """Живые записи [chat_id, user_id, имя, оставшийся ttl] для снимка состояния."""
+        now = time.monotonic()
+        with self._lock:
+            return [[chat_id, user_id, name, expires - now]
+                    for (chat_id, user_id), (name, expires) in self._items.items() if expires > now]
+
+    def load(self, items):
+        now = time.monotonic()
+        with self._lock:
+            for chat_id, user_id, name, ttl in items:
+                self._items[(chat_id, user_id)] = (name, now + min(ttl, self.ttl))
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._items), "hits": self.hits, "misses": self.misses}
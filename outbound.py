@@ -0,0 +1,298 @@
+import functools
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import requests
+from telebot.apihelper import ApiTelegramException
+from urllib3.exceptions import NewConnectionError
+
+# Методы, повтор которых ничего не дублирует: их можно повторять после любой ошибки транспорта
+REPEATABLE_METHODS = frozenset({'answer_callback_query'})
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity за раз."""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, now):
+        """Забирает токен. Возвращает 0 или сколько секунд нужно подождать."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class OutboundJob:
+    __slots__ = ('method', 'args', 'kwargs', 'key', 'attempts')
+
+    def __init__(self, method, args, kwargs, key=None):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key
+        self.attempts = 0
+
+
+def _request_not_sent(error):
+    """True, если запрос точно не дошёл до Telegram: соединение так и не установилось."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError) and error.args:
+        return isinstance(getattr(error.args[0], 'reason', None), NewConnectionError)
+    return False
+
+
+def _error_code(error):
+    return getattr(error, 'error_code', None) or type(error).__name__
+
+
+class DirectDispatcher:
+    """Вызывает методы бота сразу, только замеряя время каждого вызова."""
+
+    def __init__(self, bot, metrics=None):
+        self.bot = bot
+        self.metrics = metrics
+
+    def drain(self, timeout):
+        # Вызовы выполняются сразу, ждать нечего
+        return True
+
+    def __getattr__(self, name):
+        method = getattr(self.bot, name)
+        if self.metrics is None or not callable(method):
+            return method
+        return functools.partial(self._invoke, name)
+
+    def _invoke(self, name, *args, **kwargs):
+        method = getattr(self.bot, name)
+        if self.metrics is None:
+            return method(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        except Exception as e:
+            self.metrics.inc('bot_api_errors_total', method=name, code=_error_code(e))
+            raise
+        finally:
+            self.metrics.observe('bot_api_seconds', time.perf_counter() - started, method=name)
+
+
+class OutboundDispatcher(DirectDispatcher):
+    """
+    Очередь исходящих запросов к Telegram с соблюдением лимитов.
+
+    Используется вместо bot для send_message, edit_message_text и
+    answer_callback_query: вызов только ставит запрос в очередь, а
+    потоки-отправители выполняют его, соблюдая общий лимит (около 30
+    сообщений в секунду) и лимит на чат (около 20 в минуту в группах).
+    Ответы на нажатия кнопок отправляются раньше обычных сообщений и не
+    расходуют лимит чата. Запросы одного чата уходят строго по порядку;
+    подряд идущие правки одного сообщения склеиваются в одну. При ответе
+    429 запрос повторяется через указанный сервером retry_after.
+    Остальные методы бота вызываются напрямую.
+    """
+
+    def __init__(self, bot, global_rate=30, group_rate=20 / 60, group_burst=20,
+                 private_rate=1, private_burst=3, workers=4, max_retries=3, metrics=None):
+        super().__init__(bot, metrics)
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.private_rate = private_rate
+        self.private_burst = private_burst
+        self.workers = workers
+        self.max_retries = max_retries
+        self.sent = 0
+        self.merged = 0
+        self.retried = 0
+        self.failed = 0
+        # При доле лимита меньше 1 в секунду (много шардов) ведро всё равно вмещает один токен
+        self._global = TokenBucket(global_rate, max(1.0, global_rate))
+        self._buckets = {}
+        self._callbacks = deque()
+        self._chats = {}
+        self._ready = []
+        self._scheduled = set()
+        self._in_flight = 0
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._pid = None
+
+    # --- Методы, которые ставятся в очередь ---
+    def send_message(self, chat_id, text, **kwargs):
+        self._submit(chat_id, OutboundJob('send_message', (chat_id, text), kwargs))
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        job = OutboundJob('edit_message_text', (text, chat_id, message_id), kwargs, key=message_id)
+        self._submit(chat_id, job)
+
+    def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        self._submit(None, OutboundJob('answer_callback_query', (callback_query_id, text), kwargs))
+
+    @property
+    def pending(self):
+        with self._cond:
+            return len(self._callbacks) + sum(len(q) for q in self._chats.values()) + self._in_flight
+
+    def drain(self, timeout):
+        """Ждёт отправки всех поставленных в очередь запросов. False, если не успели за timeout."""
+        deadline = time.monotonic() + timeout
+        while self.pending:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stats(self):
+        return {"pending": self.pending, "sent": self.sent, "merged": self.merged,
+                "retried": self.retried, "failed": self.failed}
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            for index in range(self.workers):
+                threading.Thread(target=self._worker, name=f"outbound-{index}", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _submit(self, chat_id, job):
+        self._ensure_started()
+        with self._cond:
+            if chat_id is None:
+                self._callbacks.append(job)
+            else:
+                q = self._chats.get(chat_id)
+                if q is None:
+                    q = self._chats[chat_id] = deque()
+                # Новая правка того же сообщения заменяет ещё не отправленную предыдущую
+                if job.key is not None and q and q[-1].method == job.method and q[-1].key == job.key:
+                    q[-1].args, q[-1].kwargs = job.args, job.kwargs
+                    self.merged += 1
+                    return
+                q.append(job)
+                self._schedule(chat_id, time.monotonic())
+            self._cond.notify()
+
+    def _schedule(self, chat_id, ready_at):
+        if chat_id not in self._scheduled:
+            self._scheduled.add(chat_id)
+            heapq.heappush(self._ready, (ready_at, next(self._seq), chat_id))
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательный chat_id у групп и каналов
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.private_rate, self.private_burst)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def _next_job(self):
+        """Ждёт и возвращает (chat_id, job), уже уложившиеся в лимит чата."""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._callbacks:
+                    self._in_flight += 1
+                    return None, self._callbacks.popleft()
+                if self._ready and self._ready[0][0] <= now:
+                    _, _, chat_id = heapq.heappop(self._ready)
+                    wait = self._chat_bucket(chat_id).take(now)
+                    if wait:
+                        heapq.heappush(self._ready, (now + wait, next(self._seq), chat_id))
+                        continue
+                    # Чат остаётся в _scheduled, пока запрос не выполнен: так сохраняется порядок
+                    self._in_flight += 1
+                    return chat_id, self._chats[chat_id].popleft()
+                self._cond.wait(self._ready[0][0] - now if self._ready else None)
+
+    def _finish(self, chat_id, job, retry_after=None):
+        with self._cond:
+            self._in_flight -= 1
+            if chat_id is None:
+                if retry_after is not None:
+                    self._callbacks.appendleft(job)
+                    self._cond.notify()
+                return
+            q = self._chats[chat_id]
+            if retry_after is not None:
+                q.appendleft(job)
+            self._scheduled.discard(chat_id)
+            if q:
+                self._schedule(chat_id, time.monotonic() + (retry_after or 0))
+                self._cond.notify()
+            else:
+                del self._chats[chat_id]
+                self._prune_buckets()
+
+    def _prune_buckets(self):
+        # Полные вёдра ничего не ограничивают — их можно забыть
+        if len(self._buckets) > 10000:
+            now = time.monotonic()
+            for chat_id in [c for c, b in self._buckets.items() if c not in self._chats and b.is_full(now)]:
+                del self._buckets[chat_id]
+
+    def _worker(self):
+        while True:
+            chat_id, job = self._next_job()
+            while True:
+                with self._cond:
+                    wait = self._global.take(time.monotonic())
+                if not wait:
+                    break
+                time.sleep(wait)
+            retry_after = self._execute(job)
+            if chat_id is None and retry_after:
+                # У ответов на кнопки нет своей очереди с расписанием — просто ждём
+                time.sleep(retry_after)
+            self._finish(chat_id, job, retry_after)
+
+    def _execute(self, job):
+        """Выполняет запрос. Возвращает задержку до повтора или None."""
+        job.attempts += 1
+        try:
+            self._invoke(job.method, *job.args, **job.kwargs)
+            self._count('sent')
+            return None
+        except ApiTelegramException as e:
+            if e.error_code == 429 and job.attempts <= self.max_retries:
+                retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                logging.warning("Превышен лимит Telegram (%s), повтор через %s с.", job.method, retry_after,
+                                extra={"event": "outbound"})
+                self._count('retried')
+                return retry_after
+            logging.error("Ошибка Telegram при вызове %s: %s", job.method, e.description, extra={"event": "outbound"})
+        except Exception as e:
+            # После таймаута чтения или обрыва ответа Telegram мог уже выполнить
+            # запрос, и повтор sendMessage задвоил бы сообщение
+            repeatable = job.method in REPEATABLE_METHODS or _request_not_sent(e)
+            if repeatable and job.attempts <= self.max_retries:
+                self._count('retried')
+                return 2 ** (job.attempts - 1)
+            logging.error("Не удалось выполнить %s.", job.method, exc_info=True, extra={"event": "outbound"})
+        self._count('failed')
+        return None
+
+    def _count(self, name):
+        with self._cond:
+            setattr(self, name, getattr(self, name) + 1)
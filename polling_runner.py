@@ -0,0 +1,97 @@
+"""
+Запуск бота в режиме long polling вместо вебхука.
+
+Подходит для развёртываний за NAT, где Telegram не может достучаться до
+/webhook. Обновления забираются пачками через getUpdates и
+обрабатываются теми же обработчиками из main.py, параллельно по чатам.
+
+    python polling_runner.py
+"""
+import functools
+import logging
+import os
+import threading
+import time
+
+from telebot import apihelper
+
+import main
+from metrics import metrics
+from update_queue import UpdateQueue, update_chat_id
+
+
+class PollingRunner:
+    """
+    Цикл getUpdates с управлением offset.
+
+    Каждая пачка раскладывается по очереди с пулом обработчиков (как у
+    вебхука): обновления одного чата обрабатываются по порядку, разных
+    чатов — параллельно. Если очередь заполнена, цикл ждёт, а не теряет
+    обновления. offset сдвигается после постановки пачки в очередь.
+    """
+
+    def __init__(self, token, process, limit=100, timeout=50, workers=4, max_depth=1000):
+        self.token = token
+        self.limit = limit
+        self.timeout = timeout
+        self.offset = None
+        self.queue = UpdateQueue(process, workers=workers, max_depth=max_depth, overflow='reject')
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    def poll_once(self):
+        """Забирает одну пачку обновлений и ставит её в очередь. Возвращает размер пачки."""
+        # timeout — таймаут HTTP-соединения, long_polling_timeout — сколько Telegram держит запрос
+        updates = apihelper.get_updates(self.token, offset=self.offset, limit=self.limit,
+                                        timeout=10, long_polling_timeout=self.timeout)
+        metrics.inc('bot_polling_batches_total')
+        for data in updates:
+            self.offset = data['update_id'] + 1
+            if main.is_duplicate_update(data):
+                continue
+            chat_id = update_chat_id(data)
+            while not self.queue.submit(chat_id, data):
+                if self._stop.wait(0.01):
+                    # Обновление не принято: после перезапуска Telegram отдаст его снова
+                    main.update_dedupe.forget(data['update_id'])
+                    return len(updates)
+        metrics.inc('bot_polling_updates_total', len(updates))
+        return len(updates)
+
+    def run_forever(self):
+        # Пока установлен вебхук, Telegram не отдаёт обновления через getUpdates
+        main.bot.remove_webhook()
+        logging.info(f"Запущен long polling (пачки до {self.limit}, таймаут {self.timeout} с).")
+        failures = 0
+        while not self._stop.is_set():
+            try:
+                self.poll_once()
+                failures = 0
+            except Exception:
+                failures += 1
+                delay = min(30, 2 ** failures)
+                logging.error("Ошибка getUpdates, повтор через %s с.", delay, exc_info=True, extra={"event": "polling"})
+                self._stop.wait(delay)
+
+
+def create_runner():
+    runner = PollingRunner(main.TOKEN,
+                           functools.partial(main.process_update, transport='polling'),
+                           limit=int(os.getenv('POLLING_LIMIT', 100)),
+                           timeout=int(os.getenv('POLLING_TIMEOUT', 50)),
+                           workers=int(os.getenv('WEBHOOK_WORKERS', 4)),
+                           max_depth=int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000)))
+    # По SIGTERM уже полученные пачки дообрабатываются вместе с очередью вебхука
+    main.drain_queues.append(runner.queue)
+    return runner
+
+
+if __name__ == '__main__':
+    runner = create_runner()
+    try:
+        runner.run_forever()
+    except KeyboardInterrupt:
+        runner.stop()
+        time.sleep(0.1)
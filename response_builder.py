@@ -0,0 +1,113 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# Методы, вызовы которых собираются и отправляются после обработчика
+COLLECTED_METHODS = frozenset(('send_message', 'edit_message_text', 'answer_callback_query'))
+
+
+class ResponseBuilder:
+    """
+    Исходящие действия, накопленные обработчиками одного обновления.
+
+    flush() отправляет их так, чтобы игроки видели то же самое, но быстрее:
+    ответ на нажатие кнопки уходит первым, несколько правок одного
+    сообщения сводятся к последней, а независимые действия (правки разных
+    сообщений и отправка в чат) выполняются параллельно. Сообщения одного
+    чата по-прежнему уходят в исходном порядке.
+    """
+
+    def __init__(self, api, executor=None):
+        self.api = api
+        self.executor = executor
+        self._actions = []
+
+    def __getattr__(self, name):
+        if name in COLLECTED_METHODS:
+            def collect(*args, **kwargs):
+                self._actions.append((name, args, kwargs))
+            return collect
+        return getattr(self.api, name)
+
+    def _plan(self):
+        """Делит действия на ответы на кнопки и независимые цепочки действий."""
+        answers = []
+        chains = {}
+        for name, args, kwargs in self._actions:
+            if name == 'answer_callback_query':
+                answers.append((name, args, kwargs))
+            elif name == 'edit_message_text':
+                _, chat_id, message_id = (args + (None, None))[:3]
+                chat_id = kwargs.get('chat_id', chat_id)
+                message_id = kwargs.get('message_id', message_id)
+                # Правка сообщения не зависит от других сообщений; остаётся только последняя
+                key = ('edit', chat_id, message_id)
+                chains.pop(key, None)
+                chains[key] = [(name, args, kwargs)]
+            else:
+                chat_id = kwargs.get('chat_id', args[0] if args else None)
+                chains.setdefault(('send', chat_id), []).append((name, args, kwargs))
+        return answers, list(chains.values())
+
+    def flush(self):
+        answers, chains = self._plan()
+        self._actions = []
+        tasks = [[answer] for answer in answers] + chains
+        if self.executor is None or len(tasks) < 2:
+            for chain in tasks:
+                self._run(chain)
+            return
+        for future in [self.executor.submit(self._run, chain) for chain in tasks]:
+            future.result()
+
+    def _run(self, chain):
+        for name, args, kwargs in chain:
+            try:
+                getattr(self.api, name)(*args, **kwargs)
+            except Exception:
+                logging.error("Не удалось выполнить %s.", name, exc_info=True, extra={"event": "outbound"})
+
+
+class ResponseProxy:
+    """
+    Замена api для обработчиков: внутри collect() вызовы отправки
+    накапливаются в ResponseBuilder текущего потока, вне его — идут
+    напрямую.
+
+    concurrent=True имеет смысл, когда api выполняет вызовы синхронно:
+    тогда независимые действия отправляются параллельно. Очередь
+    исходящих запросов и так не блокирует обработчик.
+    """
+
+    def __init__(self, api, concurrent=False, workers=8):
+        self.api = api
+        self.concurrent = concurrent
+        self.workers = workers
+        self._local = threading.local()
+        self._executor = None
+        self._pid = None
+
+    def __getattr__(self, name):
+        builder = getattr(self._local, 'builder', None)
+        return getattr(builder if builder is not None else self.api, name)
+
+    def _get_executor(self):
+        if not self.concurrent:
+            return None
+        # Потоки пула не переживают fork, поэтому пул создаётся в каждом процессе
+        if self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="response")
+            self._pid = os.getpid()
+        return self._executor
+
+    @contextmanager
+    def collect(self):
+        builder = ResponseBuilder(self.api, self._get_executor())
+        self._local.builder = builder
+        try:
+            yield builder
+        finally:
+            self._local.builder = None
+            builder.flush()
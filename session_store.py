@@ -0,0 +1,531 @@
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from game_session import GameSession
+
+# Количество полос блокировок по чатам внутри процесса
+LOCK_STRIPES = 64
+
+
+class SessionStore:
+    """
+    Базовый интерфейс хранилища игровых сессий.
+
+    Поддерживает тот же набор операций, что и обычный словарь
+    (get, [chat_id] = ..., pop), плюс save() для изменённых сессий
+    и lock() для последовательной обработки обновлений одного чата.
+    """
+
+    # True, если сессии переживают перезапуск процесса без снимка состояния
+    persistent = False
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+        self._stripes = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self.evictions = 0
+        self._eviction_times = deque(maxlen=100000)
+
+    def _stripe(self, chat_id):
+        return self._stripes[hash(chat_id) % LOCK_STRIPES]
+
+    @contextmanager
+    def lock(self, chat_id):
+        with self._stripe(chat_id):
+            yield
+
+    def get(self, chat_id):
+        raise NotImplementedError
+
+    def __setitem__(self, chat_id, session):
+        raise NotImplementedError
+
+    def __getitem__(self, chat_id):
+        session = self.get(chat_id)
+        if session is None:
+            raise KeyError(chat_id)
+        return session
+
+    def save(self, session):
+        """Отмечает, что сессия изменилась и её нужно сохранить."""
+        self[session.chat_id] = session
+
+    def pop(self, chat_id, default=None):
+        raise NotImplementedError
+
+    def expire_idle(self, ttl):
+        """Удаляет сессии, которые не менялись дольше ttl секунд. Возвращает их количество."""
+        raise NotImplementedError
+
+    def counts(self):
+        """Число сессий по (режим, тема) — без чтения и разбора самих сессий."""
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+    def _record_eviction(self, count=1):
+        self.evictions += count
+        if self.metrics is not None:
+            self.metrics.inc('bot_session_evictions_total', count)
+        now = time.monotonic()
+        self._eviction_times.extend([now] * min(count, self._eviction_times.maxlen))
+
+    def evictions_per_minute(self):
+        deadline = time.monotonic() - 60
+        while self._eviction_times and self._eviction_times[0] < deadline:
+            self._eviction_times.popleft()
+        return len(self._eviction_times)
+
+    def approx_bytes(self):
+        """Приблизительный объём памяти под сессии в этом процессе."""
+        raise NotImplementedError
+
+    def stats(self):
+        return {
+            "sessions": len(self),
+            "approx_bytes": self.approx_bytes(),
+            "evictions_total": self.evictions,
+            "evictions_per_minute": self.evictions_per_minute(),
+        }
+
+
+class MemorySessionStore(SessionStore):
+    """
+    Хранилище сессий в памяти процесса.
+
+    Сессии упорядочены по последней активности: фоновый поток раз в
+    sweep_interval секунд удаляет простаивающие дольше idle_ttl, а при
+    превышении max_sessions вытесняется самая давно активная (LRU).
+    Число сессий по режиму и теме обновляется при каждой записи.
+    """
+
+    def __init__(self, idle_ttl=None, max_sessions=None, sweep_interval=60, metrics=None):
+        super().__init__(metrics)
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.sweep_interval = sweep_interval
+        self._sessions = OrderedDict()
+        # Чат -> (режим, тема) на момент последней записи; (режим, тема) -> число сессий
+        self._keys = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_started(self):
+        if not self.idle_ttl or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._sweeper, name="session-sweeper", daemon=True).start()
+            self._pid = os.getpid()
+
+    @contextmanager
+    def lock(self, chat_id):
+        self._ensure_started()
+        with self._stripe(chat_id):
+            try:
+                yield
+            finally:
+                self.touch(chat_id)
+
+    def touch(self, chat_id):
+        with self._lock:
+            session = self._sessions.get(chat_id)
+            if session is not None:
+                session.last_active = time.time()
+                self._sessions.move_to_end(chat_id)
+
+    def get(self, chat_id):
+        return self._sessions.get(chat_id)
+
+    def _recount(self, chat_id, session):
+        """Под self._lock: переносит чат в счётчик (режима, темы) его сессии; None — сессия удалена."""
+        old = self._keys.pop(chat_id, None)
+        if old is not None:
+            left = self._counts[old] - 1
+            if left:
+                self._counts[old] = left
+            else:
+                del self._counts[old]
+        if session is not None:
+            key = (session.mode, session.theme or '')
+            self._keys[chat_id] = key
+            self._counts[key] = self._counts.get(key, 0) + 1
+
+    def __setitem__(self, chat_id, session):
+        session.last_active = time.time()
+        with self._lock:
+            self._sessions[chat_id] = session
+            self._sessions.move_to_end(chat_id)
+            self._recount(chat_id, session)
+            while self.max_sessions and len(self._sessions) > self.max_sessions:
+                evicted_id, _ = self._sessions.popitem(last=False)
+                self._recount(evicted_id, None)
+                self._record_eviction()
+                logging.info("Превышен лимит сессий, сессия в чате %s вытеснена.", evicted_id,
+                             extra={"event": "eviction"})
+
+    def pop(self, chat_id, default=None):
+        with self._lock:
+            self._recount(chat_id, None)
+            return self._sessions.pop(chat_id, default)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def values(self):
+        with self._lock:
+            return list(self._sessions.values())
+
+    def counts(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def expire_idle(self, ttl):
+        deadline = time.time() - ttl
+        with self._lock:
+            # Сессии упорядочены по активности, поэтому достаточно просмотреть начало
+            expired = []
+            for chat_id, session in self._sessions.items():
+                if session.last_active >= deadline:
+                    break
+                expired.append(chat_id)
+        removed = 0
+        for chat_id in expired:
+            with self._stripe(chat_id):
+                with self._lock:
+                    session = self._sessions.get(chat_id)
+                    if session is not None and session.last_active < deadline:
+                        del self._sessions[chat_id]
+                        self._recount(chat_id, None)
+                        self._record_eviction()
+                        removed += 1
+        return removed
+
+    def approx_bytes(self):
+        return sum(session.approx_size() for session in self.values())
+
+    def _sweeper(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                expired = self.expire_idle(self.idle_ttl)
+                if expired:
+                    logging.info(f"Удалено неактивных сессий: {expired}.")
+            except Exception:
+                logging.error("Ошибка при удалении неактивных сессий.", exc_info=True)
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    Хранилище сессий в SQLite (режим WAL), общее для нескольких процессов.
+
+    Изменения копятся в памяти и записываются фоновым потоком одной
+    транзакцией раз в flush_interval секунд (write-behind). Чтобы два
+    процесса не обрабатывали один чат одновременно, на время обработки
+    берётся аренда строки чата в таблице session_locks. Аренда снимается
+    в той же транзакции, что записывает сессию, поэтому следующий
+    владелец всегда читает актуальное состояние. Если аренду не удалось
+    получить за lease_ttl секунд, lock() бросает TimeoutError: обновление
+    отклоняется, а не обрабатывается параллельно с другим процессом.
+    """
+
+    persistent = True
+
+    def __init__(self, path, flush_interval=0.05, batch_size=200, lease_ttl=30,
+                 idle_ttl=None, max_sessions=None, sweep_interval=60, metrics=None):
+        super().__init__(metrics)
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.lease_ttl = lease_ttl
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._local = threading.local()
+        self._tokens = itertools.count()
+        self._pid = None
+        self._init_state()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                         "chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL, "
+                         "mode TEXT, theme TEXT)")
+            self._migrate(conn)
+            conn.execute("CREATE TABLE IF NOT EXISTS session_locks ("
+                         "chat_id INTEGER PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions(updated_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS seen_updates (update_id INTEGER PRIMARY KEY)")
+
+    def _migrate(self, conn):
+        # Режим и тема хранятся отдельными столбцами, чтобы counts() не разбирал JSON каждой сессии
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(sessions)")}
+            if 'mode' not in columns:
+                conn.execute("ALTER TABLE sessions ADD COLUMN mode TEXT")
+                conn.execute("ALTER TABLE sessions ADD COLUMN theme TEXT")
+                conn.execute("UPDATE sessions SET mode = json_extract(data, '$.mode'), "
+                             "theme = json_extract(data, '$.theme')")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _init_state(self):
+        # Сессии чатов, аренду которых держит этот процесс
+        self._cache = {}
+        self._owned = {}
+        # Изменённые сессии (None — удалить) и аренды, ожидающие снятия
+        self._dirty = {}
+        self._pending_release = {}
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # В режиме WAL synchronous=NORMAL не делает fsync на каждую транзакцию
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._init_state()
+            threading.Thread(target=self._flusher, name="session-flusher", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _try_lease(self, chat_id):
+        """Одна попытка взять аренду чата. Возвращает токен владельца или None, если она занята."""
+        token = f"{os.getpid()}:{next(self._tokens)}"
+        now = time.time()
+        cursor = self._connect().execute(
+            "INSERT INTO session_locks (chat_id, owner, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(chat_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+            "WHERE session_locks.expires_at < ?",
+            (chat_id, token, now + self.lease_ttl, now))
+        return token if cursor.rowcount else None
+
+    def _claim(self, chat_id):
+        """Под полосой чата: берёт аренду и загружает сессию. None, если аренду держит другой процесс."""
+        with self._lock:
+            # Аренда ещё не снята фоновым потоком — просто продолжаем ею пользоваться
+            token = self._pending_release.pop(chat_id, None)
+        if token is None:
+            token = self._try_lease(chat_id)
+            if token is None:
+                return None
+            session = self._load(chat_id)
+            with self._lock:
+                if chat_id not in self._dirty:
+                    self._cache[chat_id] = session
+        return token
+
+    def _load(self, chat_id):
+        row = self._connect().execute("SELECT data FROM sessions WHERE chat_id = ?", (chat_id,)).fetchone()
+        return GameSession.from_dict(json.loads(row[0])) if row else None
+
+    @contextmanager
+    def lock(self, chat_id):
+        self._ensure_started()
+        stripe = self._stripe(chat_id)
+        deadline = time.monotonic() + self.lease_ttl
+        while True:
+            stripe.acquire()
+            try:
+                token = self._claim(chat_id)
+            except BaseException:
+                stripe.release()
+                raise
+            if token is not None:
+                break
+            # Аренду держит другой процесс: ждём, не занимая полосу, чтобы не стояли чаты соседей
+            stripe.release()
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Не удалось получить блокировку чата {chat_id} за {self.lease_ttl} с")
+            time.sleep(0.005)
+        try:
+            with self._lock:
+                self._owned[chat_id] = token
+            try:
+                yield
+            finally:
+                with self._lock:
+                    del self._owned[chat_id]
+                    self._pending_release[chat_id] = token
+                    # Обновляем время активности сессии вместе с ближайшей записью
+                    session = self._cache.get(chat_id)
+                    if session is not None:
+                        session.last_active = time.time()
+                        self._dirty.setdefault(chat_id, session)
+        finally:
+            stripe.release()
+
+    def get(self, chat_id):
+        self._ensure_started()
+        with self._lock:
+            if chat_id in self._dirty:
+                return self._dirty[chat_id]
+            if chat_id in self._owned or chat_id in self._pending_release:
+                return self._cache.get(chat_id)
+        return self._load(chat_id)
+
+    def __setitem__(self, chat_id, session):
+        self._ensure_started()
+        with self._lock:
+            self._cache[chat_id] = session
+            self._dirty[chat_id] = session
+            if len(self._dirty) >= self.batch_size:
+                self._wakeup.set()
+
+    def pop(self, chat_id, default=None):
+        session = self.get(chat_id)
+        with self._lock:
+            self._cache.pop(chat_id, None)
+            self._dirty[chat_id] = None
+        return default if session is None else session
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def values(self):
+        self.flush()
+        rows = self._connect().execute("SELECT data FROM sessions").fetchall()
+        return [GameSession.from_dict(json.loads(row[0])) for row in rows]
+
+    def counts(self):
+        # Несохранённые изменения последних flush_interval секунд не учитываются
+        rows = self._connect().execute("SELECT mode, theme, COUNT(*) FROM sessions GROUP BY mode, theme").fetchall()
+        return {(mode, theme or ''): count for mode, theme, count in rows}
+
+    def expire_idle(self, ttl):
+        return self._evict("DELETE FROM sessions WHERE updated_at < ? AND chat_id NOT IN "
+                           "(SELECT chat_id FROM session_locks WHERE expires_at >= ?)",
+                           time.time() - ttl)
+
+    def evict_over_limit(self, max_sessions):
+        """Удаляет самые давно активные сессии сверх max_sessions."""
+        return self._evict("DELETE FROM sessions WHERE chat_id IN "
+                           "(SELECT chat_id FROM sessions ORDER BY updated_at DESC LIMIT -1 OFFSET ?) "
+                           "AND chat_id NOT IN (SELECT chat_id FROM session_locks WHERE expires_at >= ?)",
+                           max_sessions)
+
+    def _evict(self, query, arg):
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            removed = conn.execute(query, (arg, now)).rowcount
+            conn.execute("DELETE FROM session_locks WHERE expires_at < ?", (now,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if removed:
+            self._record_eviction(removed)
+        return removed
+
+    def remember_update_id(self, update_id, window):
+        """Записывает update_id в общее окно. Возвращает False, если его уже видел какой-то воркер."""
+        conn = self._connect()
+        if not conn.execute("INSERT OR IGNORE INTO seen_updates (update_id) VALUES (?)", (update_id,)).rowcount:
+            return False
+        # update_id растут монотонно, поэтому старые записи отрезаем по номеру, время от времени
+        if update_id % 1000 == 0:
+            conn.execute("DELETE FROM seen_updates WHERE update_id < ?", (update_id - window,))
+        return True
+
+    def forget_update_id(self, update_id):
+        self._connect().execute("DELETE FROM seen_updates WHERE update_id = ?", (update_id,))
+
+    def approx_bytes(self):
+        with self._lock:
+            cached = [session for session in self._cache.values() if session is not None]
+        return sum(session.approx_size() for session in cached)
+
+    def flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            releases, self._pending_release = self._pending_release, {}
+            for chat_id in releases:
+                self._cache.pop(chat_id, None)
+        if not dirty and not releases:
+            return
+
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for chat_id, session in dirty.items():
+                if session is None:
+                    conn.execute("DELETE FROM sessions WHERE chat_id = ?", (chat_id,))
+                else:
+                    conn.execute("INSERT OR REPLACE INTO sessions (chat_id, data, updated_at, mode, theme) "
+                                 "VALUES (?, ?, ?, ?, ?)",
+                                 (chat_id, json.dumps(session.to_dict(), ensure_ascii=False), now,
+                                  session.mode, session.theme))
+            conn.executemany("DELETE FROM session_locks WHERE chat_id = ? AND owner = ?", releases.items())
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            # Возвращаем несохранённое обратно, не затирая более свежие изменения
+            with self._lock:
+                for chat_id, session in dirty.items():
+                    self._dirty.setdefault(chat_id, session)
+                for chat_id, token in releases.items():
+                    self._pending_release.setdefault(chat_id, token)
+            raise
+
+    def _flusher(self):
+        last_sweep = time.monotonic()
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+                if time.monotonic() - last_sweep >= self.sweep_interval:
+                    last_sweep = time.monotonic()
+                    expired = self.expire_idle(self.idle_ttl) if self.idle_ttl else 0
+                    if self.max_sessions:
+                        expired += self.evict_over_limit(self.max_sessions)
+                    if expired:
+                        logging.info(f"Удалено неактивных сессий: {expired}.")
+            except Exception:
+                logging.error("Ошибка записи сессий в SQLite.", exc_info=True)
+
+
+def create_session_store(metrics=None):
+    """Создаёт хранилище сессий по переменным окружения SESSION_BACKEND и SESSION_DB_PATH."""
+    backend = os.getenv('SESSION_BACKEND', 'memory')
+    # 0 отключает соответствующее ограничение
+    limits = {
+        "idle_ttl": int(os.getenv('SESSION_IDLE_TTL', 6 * 3600)) or None,
+        "max_sessions": int(os.getenv('SESSION_MAX', 100000)) or None,
+        "sweep_interval": int(os.getenv('SESSION_SWEEP_INTERVAL', 60)),
+    }
+    if backend == 'sqlite':
+        path = os.getenv('SESSION_DB_PATH', 'sessions.db')
+        logging.info(f"Сессии хранятся в SQLite: {path}.")
+        return SqliteSessionStore(path, flush_interval=float(os.getenv('SESSION_FLUSH_INTERVAL', 0.05)),
+                                  metrics=metrics, **limits)
+    if backend != 'memory':
+        raise ValueError(f"Неизвестное хранилище сессий: {backend}")
+    return MemorySessionStore(metrics=metrics, **limits)
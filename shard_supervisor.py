@@ -0,0 +1,253 @@
+"""
+Многопроцессный режим: супервизор принимает вебхуки и раздаёт обновления
+N процессам-шардам по chat_id.
+
+Каждый шард — отдельный процесс со своим main.py: чат всегда попадает
+в один и тот же шард, поэтому сессии чата живут только там, ходы
+обрабатываются строго по порядку, а общее хранилище и межпроцессные
+блокировки не нужны. Так бот использует все ядра машины.
+
+Если шард упал, супервизор запускает его заново под тем же номером:
+распределение чатов не меняется, а ещё не обработанные обновления
+переносятся в очередь нового процесса. При SESSION_BACKEND=sqlite у
+каждого шарда свой файл (SESSION_DB_PATH.shardN), и перезапущенный шард
+продолжает игры своих чатов.
+
+Режим включается явно, по умолчанию бот работает одним процессом.
+Супервизор должен быть один, поэтому gunicorn запускается с одним воркером:
+    gunicorn --workers 1 --threads 8 shard_supervisor:app
+    python shard_supervisor.py
+
+/metrics и /stats супервизора показывают только его собственные
+счётчики (очереди, перезапуски, отказы): метрики обработчиков, API и
+сессий остаются внутри шардов и наружу не публикуются.
+"""
+import atexit
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+from flask import Flask, request, abort, jsonify
+from telebot import apihelper
+
+from log_pipeline import setup_logging
+from metrics import metrics
+from update_dedupe import UpdateDeduplicator
+from update_queue import update_chat_id
+
+setup_logging()
+
+# Сколько секунд шард дообрабатывает очередь и исходящие запросы перед выходом
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', 20))
+
+
+def _shard_main(index, shards, updates):
+    """Точка входа процесса-шарда: обрабатывает обновления своей очереди по одному."""
+    # Лимит Telegram на весь бот делится между шардами
+    global_rate = float(os.getenv('OUTBOUND_GLOBAL_RATE', 30))
+    os.environ['OUTBOUND_GLOBAL_RATE'] = str(global_rate / shards)
+    if os.getenv('SESSION_BACKEND') == 'sqlite':
+        path = os.getenv('SESSION_DB_PATH', 'sessions.db')
+        os.environ['SESSION_DB_PATH'] = f"{path}.shard{index}"
+    if os.getenv('SNAPSHOT_PATH', 'state.snapshot'):
+        os.environ['SNAPSHOT_PATH'] = f"{os.getenv('SNAPSHOT_PATH', 'state.snapshot')}.shard{index}"
+
+    import main
+    logging.info(f"Шард {index} из {shards} запущен (pid {os.getpid()}).")
+    while True:
+        data = updates.get()
+        if data is None:
+            break
+        try:
+            main.process_update(data, transport='shard')
+        except Exception:
+            logging.error("Шард %s: ошибка обработки обновления %s.", index, data.get('update_id'), exc_info=True,
+                          extra={"event": "update"})
+    # Очередь шарда исчерпана: дожидаемся исходящих запросов и сохраняем снимок для следующего запуска
+    main.drain_and_snapshot(SHUTDOWN_TIMEOUT)
+    main.sessions.close()
+
+
+class ShardSupervisor:
+    """
+    Запускает шарды, раздаёт им обновления и перезапускает упавшие.
+
+    Номер шарда — hash(chat_id) % shards, как у потоков в UpdateQueue.
+    Число шардов постоянно, пока жив супервизор, поэтому перезапуск
+    шарда не перемещает чаты между процессами.
+    """
+
+    def __init__(self, shards, max_depth=1000, check_interval=1.0):
+        self.shards = max(1, shards)
+        self.max_depth = max_depth
+        self.check_interval = check_interval
+        self.restarts = [0] * self.shards
+        self.rejected = 0
+        self._context = multiprocessing.get_context('spawn')
+        self._queues = []
+        self._processes = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._pid = None
+
+    def _ensure_started(self):
+        # Процессы и очереди создаются в том процессе, который принимает вебхуки
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queues = [self._context.Queue(self.max_depth) for _ in range(self.shards)]
+            self._processes = [self._spawn(index) for index in range(self.shards)]
+            threading.Thread(target=self._monitor, name="shard-monitor", daemon=True).start()
+            self._pid = os.getpid()
+            logging.info(f"Запущено шардов: {self.shards}.")
+
+    def _spawn(self, index):
+        process = self._context.Process(target=_shard_main, args=(index, self.shards, self._queues[index]),
+                                        name=f"shard-{index}", daemon=True)
+        process.start()
+        return process
+
+    def _monitor(self):
+        while not self._stop.wait(self.check_interval):
+            for index, process in enumerate(self._processes):
+                if process.is_alive() or self._stop.is_set():
+                    continue
+                logging.error(f"Шард {index} завершился с кодом {process.exitcode}, перезапуск.")
+                self._restart(index)
+
+    def _restart(self, index):
+        """Запускает шард заново и переносит ему необработанные обновления."""
+        old = self._queues[index]
+        new = self._context.Queue(self.max_depth)
+        # Упавший процесс мог не отпустить блокировку старой очереди, поэтому
+        # новый шард читает из новой, а остаток старой перекладывается туда
+        moved = 0
+        while True:
+            try:
+                new.put_nowait(old.get(timeout=0.1))
+                moved += 1
+            except (queue.Empty, queue.Full):
+                break
+        self._queues[index] = new
+        self._processes[index] = self._spawn(index)
+        self.restarts[index] += 1
+        metrics.inc('bot_shard_restarts_total', shard=str(index))
+        logging.info(f"Шард {index} перезапущен, перенесено обновлений: {moved}.")
+
+    def shard_for(self, chat_id):
+        return hash(chat_id) % self.shards if chat_id is not None else 0
+
+    def submit(self, chat_id, data):
+        """Отдаёт обновление шарду его чата. False, если очередь шарда заполнена."""
+        self._ensure_started()
+        index = self.shard_for(chat_id)
+        try:
+            self._queues[index].put_nowait(data)
+        except queue.Full:
+            self.rejected += 1
+            metrics.inc('bot_shard_rejected_total', shard=str(index))
+            return False
+        metrics.inc('bot_shard_updates_total', shard=str(index))
+        return True
+
+    def depths(self):
+        depths = []
+        for updates in self._queues:
+            try:
+                depths.append(updates.qsize())
+            except NotImplementedError:
+                # qsize() недоступен на macOS
+                depths.append(None)
+        return depths
+
+    def stop(self, timeout=10):
+        """Просит шарды доработать очереди и ждёт их завершения."""
+        self._stop.set()
+        for updates in self._queues:
+            updates.put(None)
+        deadline = time.monotonic() + timeout
+        for process in self._processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+
+
+TOKEN = os.getenv('BOT_TOKEN')
+
+app = Flask(__name__)
+# Без SHARD_WORKERS — не больше 4 шардов: каждый держит свою копию main.py, пулы соединений
+# и долю общего лимита отправки, так что число ядер машины здесь плохой ориентир
+supervisor = ShardSupervisor(shards=int(os.getenv('SHARD_WORKERS', 0)) or min(os.cpu_count() or 1, 4),
+                             max_depth=int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000)))
+# Шардам нужно время на собственное завершение (SHUTDOWN_TIMEOUT) плюс запас на запись снимка
+atexit.register(supervisor.stop, SHUTDOWN_TIMEOUT + 10)
+# Повторы отсеиваются здесь, до раздачи по шардам
+update_dedupe = UpdateDeduplicator(window=int(os.getenv('UPDATE_DEDUPE_WINDOW', 10000)))
+
+metrics.describe('bot_webhook_seconds', "Время ответа эндпоинта /webhook")
+metrics.describe('bot_shard_updates_total', "Обновления, переданные шардам")
+metrics.gauge('bot_shard_queue_depth', lambda: {(('shard', str(index)),): depth
+                                                for index, depth in enumerate(supervisor.depths())
+                                                if depth is not None})
+
+
+@app.route('/')
+def index():
+    return "Бот 'Правда или Действие' работает!"
+
+
+@app.route('/stats')
+def stats():
+    return jsonify({
+        "shards": supervisor.shards,
+        "queue_depths": supervisor.depths(),
+        "restarts": supervisor.restarts,
+        "rejected": supervisor.rejected,
+        "duplicates": update_dedupe.suppressed,
+    })
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+@app.route('/set_webhook', methods=['GET', 'POST'])
+def set_webhook():
+    webhook_url = os.getenv('WEBHOOK_URL')
+    if not webhook_url:
+        return "WEBHOOK_URL не установлен в переменных окружения", 400
+    apihelper.set_webhook(TOKEN, url=webhook_url)
+    logging.info("Вебхук успешно установлен")
+    return "Вебхук успешно установлен", 200
+
+
+@app.route('/webhook', methods=['POST'])
+@metrics.timed('bot_webhook')
+def webhook():
+    if request.headers.get('content-type') != 'application/json':
+        abort(403)
+    data = json.loads(request.get_data().decode('utf-8'))
+    if update_dedupe.is_duplicate(data.get('update_id')):
+        metrics.inc('bot_duplicate_updates_total')
+        return '', 200
+    if not supervisor.submit(update_chat_id(data), data):
+        # Очередь шарда переполнена: Telegram повторит доставку позже
+        update_dedupe.forget(data.get('update_id'))
+        return '', 503
+    return '', 200
+
+
+if __name__ == '__main__':
+    # По умолчанию SIGTERM убил бы процесс без finally и atexit, а шарды остались бы сиротами
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        app.run(host='0.0.0.0', port=int(os.getenv('PORT', 5000)), threaded=True)
+    finally:
+        supervisor.stop(SHUTDOWN_TIMEOUT + 10)
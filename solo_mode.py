@@ -1,14 +1,24 @@
 import telebot
 from telebot import types
-import random
 import logging
+from task_deck import draw_task
 
-def get_solo_keyboard():
+def _build_solo_keyboard():
     """Создает клавиатуру для SOLO-режима."""
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
     markup.add(types.KeyboardButton('/truth'), types.KeyboardButton('/dare'))
     markup.add(types.KeyboardButton('/end'))
-    return markup
+    return markup.to_json()
+
+NO_TASKS_TEXT = "Подходящих заданий нет: в теме нет заданий этого типа или их исключает фильтр (/filter)."
+THEME_GONE_TEXT = "Выбранная тема больше недоступна. Завершите игру командой /end и выберите другую."
+
+# Клавиатура не меняется, поэтому сериализуем её один раз
+SOLO_KEYBOARD = _build_solo_keyboard()
+
+def get_solo_keyboard():
+    """Возвращает готовую (уже в JSON) клавиатуру для SOLO-режима."""
+    return SOLO_KEYBOARD
 
 def handle_solo_commands(bot, message, session, themes_data):
     """
@@ -23,13 +33,23 @@ def handle_solo_commands(bot, message, session, themes_data):
     chat_id = message.chat.id
     command = message.text.lower()
     
-    if command == '/truth' and session.theme:
-        task = random.choice(themes_data[session.theme]["truths"])
-        logging.info(f"Выбрана правда. Задание: {task}")
+    if command in ('/truth', '/dare') and session.theme and session.theme not in themes_data:
+        # Файл темы удалили во время игры
+        logging.warning("Тема '%s' не найдена.", session.theme, extra={"event": "task", "handler": "solo"})
+        bot.send_message(chat_id, THEME_GONE_TEXT, reply_markup=get_solo_keyboard())
+    elif command == '/truth' and session.theme:
+        task = draw_task(session, "truths", themes_data[session.theme])
+        if task is None:
+            bot.send_message(chat_id, NO_TASKS_TEXT, reply_markup=get_solo_keyboard())
+            return
+        logging.info("Выбрана правда. Задание: %s", task, extra={"event": "task", "handler": "solo_truth"})
         bot.send_message(chat_id, f"Правда: {task}", reply_markup=get_solo_keyboard())
     elif command == '/dare' and session.theme:
-        task = random.choice(themes_data[session.theme]["dares"])
-        logging.info(f"Выбрано действие. Задание: {task}")
+        task = draw_task(session, "dares", themes_data[session.theme])
+        if task is None:
+            bot.send_message(chat_id, NO_TASKS_TEXT, reply_markup=get_solo_keyboard())
+            return
+        logging.info("Выбрано действие. Задание: %s", task, extra={"event": "task", "handler": "solo_dare"})
         bot.send_message(chat_id, f"Действие: {task}", reply_markup=get_solo_keyboard())
     elif command == '/end':
         # Команда /end обрабатывается в main.py
@@ -0,0 +1,82 @@
+import base64
+import random
+import sys
+from array import array
+
+
+class TaskDeck:
+    """
+    Колода заданий одной темы и одного типа для конкретной сессии.
+
+    Хранит не сами строки, а перестановку их индексов в компактном массиве
+    и курсор. Перемешивание ленивое (Фишер — Йейтс по одному шагу на каждое
+    вытягивание), поэтому задания не повторяются, пока колода не закончится,
+    а затем она перемешивается заново.
+    """
+
+    __slots__ = ('order', 'cursor')
+
+    def __init__(self, size):
+        self.order = array('H' if size <= 0xFFFF else 'I', range(size))
+        self.cursor = 0
+
+    def __len__(self):
+        return len(self.order)
+
+    def draw(self):
+        order = self.order
+        size = len(order)
+        i = self.cursor
+        upper = size - 1
+        if i >= size:
+            i = 0
+            # Последнее задание прошлого круга лежит в конце массива —
+            # не даём ему выпасть первым в новом круге
+            if size > 1:
+                upper = size - 2
+        j = random.randint(i, upper)
+        order[i], order[j] = order[j], order[i]
+        self.cursor = i + 1
+        return order[i]
+
+    def approx_size(self):
+        return sys.getsizeof(self) + sys.getsizeof(self.order)
+
+    def to_list(self):
+        return [self.order.typecode, base64.b64encode(self.order.tobytes()).decode('ascii'), self.cursor]
+
+    @classmethod
+    def from_list(cls, data):
+        typecode, payload, cursor = data
+        deck = cls.__new__(cls)
+        deck.order = array(typecode)
+        deck.order.frombytes(base64.b64decode(payload))
+        deck.cursor = cursor
+        return deck
+
+
+def draw_task(session, task_type, theme):
+    """
+    Вытягивает следующее задание типа task_type ('truths' или 'dares') из темы.
+
+    Если у заданий темы нет весов и тегов (или они все равны, а фильтров
+    нет), задания идут из колоды сессии без повторов. Иначе выбор делает
+    таблица псевдонимов TaskSelector с учётом весов и session.filters.
+    Возвращает None, если заданий этого типа в теме нет или под фильтры
+    не подходит ни одно.
+    """
+    tasks = theme[task_type]
+    if not tasks:
+        return None
+    selector = theme["selectors"][task_type]
+    if selector is not None and (session.filters or not selector.uniform):
+        index = selector.draw(session.filters)
+        return tasks[index] if index is not None else None
+
+    key = (session.theme, task_type)
+    deck = session.decks.get(key)
+    # Если набор заданий темы изменился, колода больше не соответствует ему
+    if deck is None or len(deck) != len(tasks):
+        deck = TaskDeck(len(tasks))
+        session.decks[key] = deck
+    return tasks[deck.draw()]
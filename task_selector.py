@@ -0,0 +1,127 @@
+import random
+import re
+import threading
+from array import array
+from collections import OrderedDict
+
+# Необязательный префикс строки задания: "[3, spice:2, party] Текст задания".
+# Число — вес (по умолчанию 1), остальное — теги.
+META_PREFIX = re.compile(r'^\[([^\]]*)\]\s*(.+)$')
+
+# Сколько таблиц псевдонимов (по одной на набор фильтров) хранит один TaskSelector
+MAX_TABLES = 64
+
+
+def parse_task_line(line):
+    """Разбирает строку задания на (текст, вес, теги)."""
+    match = META_PREFIX.match(line)
+    if not match:
+        return line, 1.0, ()
+    weight = 1.0
+    tags = []
+    for item in match.group(1).split(','):
+        item = item.strip().lower()
+        if not item:
+            continue
+        try:
+            weight = max(0.0, float(item))
+        except ValueError:
+            tags.append(item)
+    return match.group(2), weight, tuple(tags)
+
+
+def matches(tags, filters):
+    """Подходит ли задание под фильтры сессии: 'tag' — тег обязателен, '!tag' — запрещён."""
+    for tag in filters:
+        if tag.startswith('!'):
+            if tag[1:] in tags:
+                return False
+        elif tag not in tags:
+            return False
+    return True
+
+
+class AliasTable:
+    """
+    Таблица псевдонимов Уолкера (метод Воза): выбор с весами за O(1)
+    независимо от числа заданий. indices — номера заданий в теме.
+    """
+
+    __slots__ = ('indices', 'prob', 'alias')
+
+    def __init__(self, indices, weights):
+        size = len(indices)
+        self.indices = array('I', indices)
+        self.prob = array('d', [1.0]) * size
+        self.alias = array('I', range(size))
+        total = sum(weights)
+        if not size or total <= 0:
+            return
+        scaled = [weight * size / total for weight in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.prob[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] += scaled[less] - 1.0
+            (small if scaled[more] < 1.0 else large).append(more)
+        # Остатки из-за погрешности округления выбираются с вероятностью 1
+
+    def __len__(self):
+        return len(self.indices)
+
+    def draw(self):
+        if not self.indices:
+            return None
+        i = random.randrange(len(self.indices))
+        if random.random() >= self.prob[i]:
+            i = self.alias[i]
+        return self.indices[i]
+
+
+class TaskSelector:
+    """
+    Веса и теги заданий одной темы и одного типа.
+
+    Таблицы псевдонимов строятся при первом выборе с данным набором
+    фильтров и живут, пока не изменится файл темы: ThemeStore создаёт
+    новый TaskSelector только для изменившихся файлов. Фильтры задают
+    игроки командой /filter, поэтому хранятся только MAX_TABLES недавно
+    использованных таблиц.
+    """
+
+    __slots__ = ('weights', 'tags', 'uniform', '_tables', '_lock')
+
+    def __init__(self, weights, tags):
+        self.weights = array('d', weights)
+        self.tags = tuple(frozenset(t) for t in tags) if any(tags) else None
+        self.uniform = len(set(weights)) <= 1 and all(w > 0 for w in weights)
+        self._tables = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_meta(cls, meta):
+        """meta — (веса, теги) из parse_theme_file или None, если у заданий нет префиксов."""
+        return cls(*meta) if meta is not None else None
+
+    def table(self, filters=()):
+        with self._lock:
+            table = self._tables.get(filters)
+            if table is not None:
+                self._tables.move_to_end(filters)
+                return table
+        tags = self.tags
+        indices = [i for i, weight in enumerate(self.weights)
+                   if weight > 0 and matches(tags[i] if tags else (), filters)]
+        # Одновременная сборка одной таблицы в двух потоках безвредна
+        table = AliasTable(indices, [self.weights[i] for i in indices])
+        with self._lock:
+            self._tables[filters] = table
+            if len(self._tables) > MAX_TABLES:
+                self._tables.popitem(last=False)
+        return table
+
+    def draw(self, filters=()):
+        """Номер задания с учётом весов и фильтров или None, если подходящих нет."""
+        return self.table(filters).draw()
@@ -0,0 +1,42 @@
+import gc
+import os
+import sys
+import threading
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from metrics import Metrics
+
+
+class MetricsShardTest(unittest.TestCase):
+
+    def test_exited_threads_are_folded_into_base(self):
+        metrics = Metrics()
+
+        def work():
+            metrics.inc('requests_total', route='a')
+            metrics.observe('latency', 0.01)
+
+        for _ in range(50):
+            thread = threading.Thread(target=work)
+            thread.start()
+            thread.join()
+        gc.collect()
+
+        self.assertEqual(len(metrics._shards), 0)
+        self.assertEqual(metrics.counter_value('requests_total', route='a'), 50)
+        _, histograms = metrics.collect()
+        self.assertEqual(histograms[('latency', ())][-1], 50)
+
+    def test_live_thread_shard_is_kept(self):
+        metrics = Metrics()
+        metrics.inc('requests_total')
+        self.assertEqual(len(metrics._shards), 1)
+        metrics.inc('requests_total')
+        self.assertEqual(metrics.counter_value('requests_total'), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
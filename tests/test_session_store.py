@@ -0,0 +1,95 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from game_session import GameSession
+from session_store import SqliteSessionStore
+
+
+class SqliteSessionStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._directory.name, 'sessions.db')
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        self._directory.cleanup()
+
+    def store(self, **kwargs):
+        store = SqliteSessionStore(self.path, **kwargs)
+        self.stores.append(store)
+        return store
+
+    def test_second_owner_waits_and_sees_first_owner_writes(self):
+        first, second = self.store(), self.store()
+        entered = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            with first.lock(1):
+                first[1] = GameSession('SOLO', [10], 1)
+                entered.set()
+                release.wait(5)
+
+        holder = threading.Thread(target=hold)
+        holder.start()
+        self.assertTrue(entered.wait(5))
+
+        seen = []
+
+        def wait_for_lease():
+            with second.lock(1):
+                seen.append(second.get(1))
+
+        waiter = threading.Thread(target=wait_for_lease)
+        waiter.start()
+        time.sleep(0.2)
+        # Аренда у первого хранилища: второй ждёт
+        self.assertEqual(seen, [])
+
+        release.set()
+        holder.join(5)
+        waiter.join(5)
+        self.assertEqual(len(seen), 1)
+        self.assertIsNotNone(seen[0])
+        self.assertEqual((seen[0].mode, seen[0].players), ('SOLO', [10]))
+
+    def test_lock_raises_when_lease_is_held_elsewhere(self):
+        store = self.store(lease_ttl=0.2)
+        store._connect().execute("INSERT INTO session_locks (chat_id, owner, expires_at) VALUES (?, ?, ?)",
+                                 (1, 'other:0', time.time() + 60))
+        started = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            with store.lock(1):
+                pass
+        self.assertLess(time.monotonic() - started, 5)
+        # Полоса блокировок не осталась занятой
+        with store.lock(1 + 64 * 1000):
+            pass
+
+    def test_pop_inside_lock_deletes_row(self):
+        store = self.store()
+        with store.lock(1):
+            store[1] = GameSession('DUO', [10, 20], 1)
+        store.flush()
+        self.assertEqual(len(store), 1)
+
+        with store.lock(1):
+            self.assertEqual(store.pop(1).mode, 'DUO')
+            self.assertIsNone(store.get(1))
+        store.flush()
+        self.assertEqual(len(store), 0)
+        self.assertIsNone(self.store().get(1))
+
+
+if __name__ == '__main__':
+    unittest.main()
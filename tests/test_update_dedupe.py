@@ -0,0 +1,102 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from session_store import SqliteSessionStore
+from update_dedupe import UpdateDeduplicator
+
+
+class UpdateDeduplicatorTest(unittest.TestCase):
+
+    def test_repeat_is_duplicate(self):
+        dedupe = UpdateDeduplicator(window=10)
+        self.assertFalse(dedupe.is_duplicate(1))
+        self.assertTrue(dedupe.is_duplicate(1))
+        self.assertEqual(dedupe.suppressed, 1)
+
+    def test_forget_allows_redelivery(self):
+        dedupe = UpdateDeduplicator(window=10)
+        self.assertFalse(dedupe.is_duplicate(1))
+        dedupe.forget(1)
+        self.assertFalse(dedupe.is_duplicate(1))
+        self.assertEqual(dedupe.suppressed, 0)
+        self.assertEqual(dedupe.dump(), [1])
+
+    def test_forget_clears_shared_window(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = SqliteSessionStore(os.path.join(directory, 'sessions.db'))
+            try:
+                first = UpdateDeduplicator(window=10, shared=store)
+                second = UpdateDeduplicator(window=10, shared=store)
+                self.assertFalse(first.is_duplicate(7))
+                self.assertTrue(second.is_duplicate(7))
+                first.forget(7)
+                self.assertFalse(UpdateDeduplicator(window=10, shared=store).is_duplicate(7))
+            finally:
+                store.close()
+
+
+class WebhookRedeliveryTest(unittest.TestCase):
+    """Отклонённое вебхуком обновление должно быть принято при повторной доставке."""
+
+    @classmethod
+    def setUpClass(cls):
+        env = {
+            'BOT_TOKEN': '123:test',
+            # Запросы к Bot API не нужны: закрытый порт, без повторов
+            'TELEGRAM_API_URL': 'http://127.0.0.1:9/bot{0}/{1}',
+            'HTTP_RETRIES': '0',
+            'SNAPSHOT_PATH': '',
+            'THEME_CACHE_PATH': '',
+            'THEME_PACK_PATH': '',
+            'SESSION_BACKEND': 'memory',
+        }
+        cls._env = mock.patch.dict(os.environ, env)
+        cls._env.start()
+        cwd = os.getcwd()
+        os.chdir(ROOT)
+        try:
+            import main
+        finally:
+            os.chdir(cwd)
+        cls.main = main
+        cls.client = main.app.test_client()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._env.stop()
+
+    def post(self, update):
+        return self.client.post('/webhook', data=json.dumps(update), content_type='application/json')
+
+    def test_rejected_update_is_not_duplicate(self):
+        update = {"update_id": 100001}
+        queue = mock.Mock()
+        queue.submit.side_effect = [False, True]
+        with mock.patch.object(self.main, 'update_queue', queue), \
+                mock.patch.object(self.main, 'WEBHOOK_ASYNC', True):
+            self.assertEqual(self.post(update).status_code, 503)
+            self.assertEqual(self.post(update).status_code, 200)
+            self.assertEqual(queue.submit.call_count, 2)
+            # Принятое обновление дальше отсеивается как обычно
+            self.assertEqual(self.post(update).status_code, 200)
+            self.assertEqual(queue.submit.call_count, 2)
+
+    def test_failed_sync_update_is_not_duplicate(self):
+        update = {"update_id": 100002}
+        process = mock.Mock(side_effect=[RuntimeError("сбой"), None])
+        with mock.patch.object(self.main, 'process_update', process), \
+                mock.patch.object(self.main, 'WEBHOOK_ASYNC', False):
+            self.assertEqual(self.post(update).status_code, 500)
+            self.assertEqual(self.post(update).status_code, 200)
+            self.assertEqual(process.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
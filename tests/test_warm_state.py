@@ -0,0 +1,48 @@
+import os
+import signal
+import sys
+import threading
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from warm_state import GracefulShutdown
+
+
+class GracefulShutdownTest(unittest.TestCase):
+
+    def setUp(self):
+        self.original = signal.getsignal(signal.SIGTERM)
+
+    def tearDown(self):
+        signal.signal(signal.SIGTERM, self.original)
+
+    def test_drain_does_not_deadlock_on_lock_held_by_main_thread(self):
+        """Сигнал пришёл, пока главный поток держит блокировку, нужную снимку."""
+        lock = threading.Lock()
+        drained = threading.Event()
+        chained = threading.Event()
+
+        def drain(timeout):
+            with lock:
+                drained.set()
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: chained.set())
+        shutdown = GracefulShutdown(drain, timeout=1).install()
+        with lock:
+            os.kill(os.getpid(), signal.SIGTERM)
+            time.sleep(0.05)
+            self.assertTrue(shutdown.stopping)
+            self.assertFalse(drained.is_set())
+        self.assertTrue(drained.wait(5))
+        # Повторный сигнал доставляется главному потоку при выполнении байткода
+        deadline = time.monotonic() + 5
+        while not chained.is_set() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(chained.is_set())
+
+
+if __name__ == '__main__':
+    unittest.main()
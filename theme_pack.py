@@ -0,0 +1,141 @@
+"""
+Компактный бинарный пакет тем (themes.pack).
+
+Файлы themes/*.txt остаются исходниками; пакет собирается из них и
+содержит таблицу смещений и тексты заданий в UTF-8 одним блоком.
+Процессы открывают пакет через mmap и декодируют только вытянутое
+задание, поэтому все воркеры делят одни и те же страницы через кэш ОС,
+а не держат по копии каждой строки в своей куче.
+
+Формат:
+    заголовок   '<4sII': MAGIC, PACK_FORMAT, длина метаданных
+    метаданные  marshal: исходные файлы и их (mtime_ns, size), темы
+                [имя, начало правд, число правд, начало действий, число действий,
+                 файл темы, (веса и теги правд, веса и теги действий)]
+    смещения    array('I') на count + 1 элементов, выровнено по 4 байтам
+    тексты      UTF-8 всех заданий подряд
+
+Сборка (например, в buildCommand):
+    python theme_pack.py [themes] [themes.pack]
+"""
+import logging
+import marshal
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections.abc import Sequence
+
+MAGIC = b'TDPK'
+PACK_FORMAT = 2
+HEADER = struct.Struct('<4sII')
+
+
+class PackedTasks(Sequence):
+    """Список заданий одной темы в пакете: строка декодируется при обращении по индексу."""
+
+    __slots__ = ('_pack', '_start', '_count')
+
+    def __init__(self, pack, start, count):
+        self._pack = pack
+        self._start = start
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("индекс задания вне диапазона")
+        return self._pack.text(self._start + index)
+
+
+class ThemePack:
+    """Открытый через mmap пакет тем."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, meta_size = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != PACK_FORMAT:
+            raise ValueError(f"'{path}' не является пакетом тем формата {PACK_FORMAT}")
+        meta = marshal.loads(self._map[HEADER.size:HEADER.size + meta_size])
+        if meta["byteorder"] != sys.byteorder:
+            raise ValueError(f"Пакет тем '{path}' собран для другого порядка байт")
+        self.directory = meta["directory"]
+        self.sources = meta["sources"]
+
+        offsets_start = _align(HEADER.size + meta_size)
+        offsets_end = offsets_start + (meta["count"] + 1) * 4
+        self._offsets = memoryview(self._map)[offsets_start:offsets_end].cast('I')
+        self._blob = offsets_end
+        self.themes = {}
+        # Имя темы -> (файл, метаданные заданий из parse_theme_file)
+        self.task_meta = {}
+        for name, truths_start, truths_count, dares_start, dares_count, filename, task_meta in meta["themes"]:
+            self.themes[name] = {"truths": PackedTasks(self, truths_start, truths_count),
+                                 "dares": PackedTasks(self, dares_start, dares_count)}
+            self.task_meta[name] = (filename, task_meta)
+
+    def text(self, index):
+        start = self._blob + self._offsets[index]
+        return str(self._map[start:self._blob + self._offsets[index + 1]], 'utf-8')
+
+
+def _align(position):
+    return (position + 3) & ~3
+
+
+def build_pack(path, themes, sources, directory):
+    """
+    Записывает пакет: themes — {имя: {"truths": [...], "dares": [...], "filename": ..., "meta": ...}},
+    sources — {имя файла: (mtime_ns, size)} исходников, из которых он собран.
+    Файл подменяется атомарно, уже открытые пакеты продолжают работать.
+    """
+    offsets = array('I', [0])
+    blob = bytearray()
+    entries = []
+
+    def add(tasks):
+        start = len(offsets) - 1
+        for task in tasks:
+            blob.extend(task.encode('utf-8'))
+            offsets.append(len(blob))
+        return start, len(tasks)
+
+    for name, tasks in themes.items():
+        entries.append([name, *add(tasks["truths"]), *add(tasks["dares"]), tasks["filename"], tasks["meta"]])
+
+    meta = marshal.dumps({"directory": directory, "sources": sources, "themes": entries,
+                          "count": len(offsets) - 1, "byteorder": sys.byteorder})
+    header = HEADER.pack(MAGIC, PACK_FORMAT, len(meta))
+    padding = b'\0' * (_align(len(header) + len(meta)) - len(header) - len(meta))
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        f.write(meta)
+        f.write(padding)
+        f.write(offsets.tobytes())
+        f.write(blob)
+    os.replace(tmp_path, path)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    directory = sys.argv[1] if len(sys.argv) > 1 else 'themes'
+    path = sys.argv[2] if len(sys.argv) > 2 else 'themes.pack'
+    from theme_store import ThemeStore
+    store = ThemeStore(directory, pack_path=path)
+    themes = store.get()
+    tasks = sum(len(theme["truths"]) + len(theme["dares"]) for theme in themes.values())
+    logging.info(f"Пакет тем '{path}': тем {len(themes)}, заданий {tasks}, {os.path.getsize(path)} байт.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+import logging
+import marshal
+import os
+import struct
+import threading
+import time
+
+from task_selector import TaskSelector, parse_task_line
+from theme_pack import ThemePack, build_pack
+
+# Версия формата кэша разобранных тем на диске
+CACHE_FORMAT = 2
+
+
+def parse_theme_file(file_path):
+    """
+    Разбирает файл темы на списки правд и действий и их метаданные
+    (truths_meta, dares_meta): (веса, теги) раздела или None, если ни у
+    одной его строки нет префикса вида "[3, spice:2] ".
+    """
+    current_section = None
+    sections = {'truths': ([], [], []), 'dares': ([], [], [])}
+    prefixed = set()
+
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line == 'TRUTHS:':
+                current_section = 'truths'
+            elif line == 'DARES:':
+                current_section = 'dares'
+            elif line and not line.startswith('#') and current_section:
+                text, weight, tags = parse_task_line(line)
+                if text is not line:
+                    prefixed.add(current_section)
+                texts, weights, all_tags = sections[current_section]
+                texts.append(text)
+                weights.append(weight)
+                all_tags.append(tags)
+
+    meta = tuple((sections[name][1], sections[name][2]) if name in prefixed else None
+                 for name in ('truths', 'dares'))
+    return sections['truths'][0], sections['dares'][0], meta
+
+
+class ThemeStore:
+    """
+    Темы из файлов themes/*.txt с подхватом изменений без перезапуска.
+
+    Не чаще раза в poll_interval секунд get() сверяет mtime и размер
+    файлов и заново разбирает только изменившиеся. Новый набор тем
+    собирается целиком и подменяется одной операцией присваивания,
+    поэтому читатели никогда не видят наполовину загруженную тему.
+    Разобранные файлы кэшируются на диске (marshal), чтобы холодный
+    старт не разбирал текст заново.
+
+    С pack_path темы читаются из пакета theme_pack.py через mmap, а не
+    хранятся строками в памяти процесса. Пакет пересобирается, когда
+    исходники расходятся с записанными в нём mtime и размерами; если его
+    уже пересобрал другой процесс, он просто открывается заново. Для
+    сборки используется тот же кэш на диске: разбираются только
+    изменившиеся файлы, а в памяти разобранные темы не остаются.
+    """
+
+    def __init__(self, directory='themes', poll_interval=5, cache_path=None, pack_path=None):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.cache_path = cache_path
+        self.pack_path = pack_path
+        self._pack = None
+        # Имя файла -> ((mtime_ns, size), {"truths": TaskSelector, "dares": TaskSelector})
+        self._selectors = {}
+        # Имя файла -> ((mtime_ns, size), truths, dares, meta)
+        self._files = self._read_cache() if not pack_path else {}
+        self._snapshot = (0, {})
+        self._last_check = 0
+        self._reload_lock = threading.Lock()
+        self.reload()
+
+    @property
+    def version(self):
+        return self._snapshot[0]
+
+    def get(self):
+        """
+        Текущий набор тем: {имя темы: {"truths": [...], "dares": [...], "selectors": {...}}}.
+        selectors[тип] — TaskSelector с весами и тегами или None, если их в файле нет.
+        """
+        if time.monotonic() - self._last_check >= self.poll_interval:
+            # Проверку делает один поток, остальные продолжают работать со старым набором
+            if self._reload_lock.acquire(blocking=False):
+                try:
+                    self._reload()
+                finally:
+                    self._reload_lock.release()
+        return self._snapshot[1]
+
+    def snapshot(self):
+        """Пара (версия, темы); версия меняется при каждом изменении набора тем."""
+        self.get()
+        return self._snapshot
+
+    def reload(self):
+        with self._reload_lock:
+            return self._reload()
+
+    def _scan(self):
+        signatures = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.endswith('.txt') and entry.is_file():
+                    stat = entry.stat()
+                    signatures[entry.name] = (stat.st_mtime_ns, stat.st_size)
+        return signatures
+
+    def _reload(self):
+        self._last_check = time.monotonic()
+        if not os.path.exists(self.directory):
+            logging.warning(f"Директория '{self.directory}' не найдена. Создаю ее...")
+            os.makedirs(self.directory)
+
+        try:
+            signatures = self._scan()
+        except OSError:
+            logging.error(f"Не удалось прочитать директорию '{self.directory}'.", exc_info=True)
+            return False
+        if self.pack_path:
+            return self._reload_pack(signatures)
+
+        files, changed = self._parse_files(signatures, self._files)
+        if not changed and self._snapshot[0]:
+            return False
+
+        themes = {}
+        selectors = {}
+        for filename in sorted(files):
+            signature, truths, dares, meta = files[filename]
+            if truths or dares:
+                themes[os.path.splitext(filename)[0]] = {"truths": truths, "dares": dares,
+                                                         "selectors": self._get_selectors(filename, signature, meta, selectors)}
+
+        self._files = files
+        self._selectors = selectors
+        self._snapshot = (self._snapshot[0] + 1, themes)
+        if changed:
+            self._write_cache(files)
+        return True
+
+    def _parse_files(self, signatures, cached_files):
+        """
+        Разбирает файлы, чьи mtime и размер разошлись с cached_files.
+        Возвращает (files, changed): files в формате self._files и
+        множество изменившихся или удалённых файлов.
+        """
+        files = {}
+        changed = set(cached_files) - set(signatures)
+        for filename, signature in signatures.items():
+            cached = cached_files.get(filename)
+            if cached is not None and tuple(cached[0]) == signature:
+                files[filename] = cached
+                continue
+            try:
+                truths, dares, meta = parse_theme_file(os.path.join(self.directory, filename))
+            except (OSError, UnicodeDecodeError):
+                logging.error(f"Не удалось прочитать тему из файла '{filename}'.", exc_info=True)
+                if cached is not None:
+                    files[filename] = cached
+                continue
+            files[filename] = (signature, truths, dares, meta)
+            changed.add(filename)
+            logging.info(f"Загружена тема '{os.path.splitext(filename)[0]}' из файла '{filename}'.")
+        return files, changed
+
+    def _reload_pack(self, signatures):
+        pack = self._pack
+        if pack is None or pack.sources != signatures:
+            pack = self._open_pack()
+            if pack is None or pack.directory != self.directory or pack.sources != signatures:
+                pack = self._build_pack(signatures)
+                if pack is None:
+                    return False
+        if pack is self._pack:
+            return False
+        themes = {}
+        selectors = {}
+        for name, theme in pack.themes.items():
+            filename, meta = pack.task_meta[name]
+            themes[name] = {**theme, "selectors": self._get_selectors(filename, pack.sources[filename], meta, selectors)}
+        self._pack = pack
+        self._selectors = selectors
+        self._snapshot = (self._snapshot[0] + 1, themes)
+        return True
+
+    def _get_selectors(self, filename, signature, meta, selectors):
+        """
+        Селекторы заданий файла: для неизменившегося файла берутся прежние
+        вместе с уже построенными таблицами, для изменившегося создаются заново.
+        """
+        cached = self._selectors.get(filename)
+        if cached is not None and cached[0] == tuple(signature):
+            selectors[filename] = cached
+            return cached[1]
+        built = {"truths": TaskSelector.from_meta(meta[0]), "dares": TaskSelector.from_meta(meta[1])}
+        selectors[filename] = (tuple(signature), built)
+        return built
+
+    def _open_pack(self):
+        try:
+            return ThemePack(self.pack_path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, EOFError, KeyError, TypeError, struct.error):
+            logging.warning(f"Пакет тем '{self.pack_path}' повреждён, он будет собран заново.")
+            return None
+
+    def _build_pack(self, signatures):
+        # Кэш читается только на время сборки, чтобы строки тем не оставались в куче процесса
+        files, changed = self._parse_files(signatures, self._read_cache())
+        if changed:
+            self._write_cache(files)
+        themes = {}
+        for filename in sorted(files):
+            signature, truths, dares, meta = files[filename]
+            if truths or dares:
+                themes[os.path.splitext(filename)[0]] = {"truths": truths, "dares": dares,
+                                                         "filename": filename, "meta": meta}
+        try:
+            build_pack(self.pack_path, themes, signatures, self.directory)
+            pack = ThemePack(self.pack_path)
+        except (OSError, ValueError):
+            logging.error(f"Не удалось собрать пакет тем '{self.pack_path}'.", exc_info=True)
+            if self._snapshot[0]:
+                return None
+            # Без пакета темы остаются в памяти процесса, бот продолжает работать
+            selectors = {}
+            self._snapshot = (1, {name: {"truths": theme["truths"], "dares": theme["dares"],
+                                         "selectors": self._get_selectors(theme["filename"], signatures[theme["filename"]],
+                                                                          theme["meta"], selectors)}
+                                  for name, theme in themes.items()})
+            self._selectors = selectors
+            return None
+        logging.info(f"Пакет тем '{self.pack_path}' собран: тем {len(themes)}.")
+        return pack
+
+    def _read_cache(self):
+        if not self.cache_path:
+            return {}
+        try:
+            with open(self.cache_path, 'rb') as f:
+                data = marshal.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, EOFError, ValueError, TypeError):
+            logging.warning(f"Кэш тем '{self.cache_path}' повреждён, темы будут разобраны заново.")
+            return {}
+        if not isinstance(data, dict) or data.get("format") != CACHE_FORMAT or data.get("directory") != self.directory:
+            return {}
+        return data["files"]
+
+    def _write_cache(self, files):
+        if not self.cache_path:
+            return
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                marshal.dump({"format": CACHE_FORMAT, "directory": self.directory, "files": files}, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            logging.warning(f"Не удалось записать кэш тем '{self.cache_path}'.", exc_info=True)
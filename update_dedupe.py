@@ -0,0 +1,69 @@
+import threading
+from collections import deque
+
+
+class UpdateDeduplicator:
+    """
+    Окно последних update_id для отсева повторных доставок Telegram.
+
+    Локально это кольцевой буфер плюс множество на window элементов.
+    Если передан shared (например, SqliteSessionStore), окно ведётся
+    ещё и в общем хранилище, чтобы повтор, пришедший в другой воркер,
+    тоже был отброшен.
+    """
+
+    def __init__(self, window=10000, shared=None):
+        self.window = window
+        self.shared = shared
+        self.suppressed = 0
+        self._ring = deque()
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    def forget(self, update_id):
+        """
+        Снимает отметку с update_id, если обновление так и не было принято
+        (очередь переполнена, обработка упала): повторная доставка Telegram
+        тогда будет обработана, а не отброшена как дубликат.
+        """
+        if update_id is None:
+            return
+        with self._lock:
+            if update_id in self._seen:
+                self._seen.discard(update_id)
+                self._ring.remove(update_id)
+        if self.shared is not None:
+            self.shared.forget_update_id(update_id)
+
+    def dump(self):
+        with self._lock:
+            return list(self._ring)
+
+    def load(self, update_ids):
+        """Восстанавливает окно из снимка, чтобы повторы после перезапуска тоже отсеивались."""
+        with self._lock:
+            for update_id in update_ids:
+                if update_id not in self._seen:
+                    self._seen.add(update_id)
+                    self._ring.append(update_id)
+            while len(self._ring) > self.window:
+                self._seen.discard(self._ring.popleft())
+
+    def is_duplicate(self, update_id):
+        """Отмечает update_id как полученный. Возвращает True, если он уже встречался."""
+        if update_id is None:
+            return False
+        with self._lock:
+            if update_id in self._seen:
+                self.suppressed += 1
+                return True
+            self._seen.add(update_id)
+            self._ring.append(update_id)
+            if len(self._ring) > self.window:
+                self._seen.discard(self._ring.popleft())
+
+        if self.shared is not None and not self.shared.remember_update_id(update_id, self.window):
+            with self._lock:
+                self.suppressed += 1
+            return True
+        return False
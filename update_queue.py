@@ -0,0 +1,125 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+
+def update_chat_id(data):
+    """Достаёт chat_id из сырого JSON обновления (без полного разбора в объекты telebot)."""
+    for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        message = data.get(key)
+        if message:
+            return message['chat']['id']
+
+    callback = data.get('callback_query')
+    if callback:
+        message = callback.get('message')
+        if message:
+            return message['chat']['id']
+        return callback['from']['id']
+
+    for key in ('my_chat_member', 'chat_member', 'chat_join_request'):
+        member = data.get(key)
+        if member:
+            return member['chat']['id']
+
+    for value in data.values():
+        if isinstance(value, dict) and 'from' in value:
+            return value['from']['id']
+    return None
+
+
+def update_user_id(data):
+    """Достаёт id отправителя из сырого JSON обновления."""
+    for value in data.values():
+        if isinstance(value, dict) and 'from' in value:
+            return value['from']['id']
+    return None
+
+
+class UpdateQueue:
+    """
+    Ограниченная очередь обновлений с пулом потоков-обработчиков.
+
+    Обновления одного чата всегда попадают к одному и тому же потоку,
+    поэтому внутри чата они обрабатываются строго по порядку.
+
+    Политика переполнения (overflow):
+    'reject' — submit() возвращает False, вебхук отвечает ошибкой и Telegram повторит доставку позже;
+    'drop'   — обновление отбрасывается с записью в лог, Telegram получает 200.
+    """
+
+    def __init__(self, process, workers=4, max_depth=1000, overflow='reject'):
+        if overflow not in ('reject', 'drop'):
+            raise ValueError(f"Неизвестная политика переполнения очереди: {overflow}")
+        self.process = process
+        self.workers = max(1, workers)
+        self.max_depth = max_depth
+        self.overflow = overflow
+        self.dropped = 0
+        self.rejected = 0
+        self._depth = 0
+        self._lock = threading.Lock()
+        self._queues = []
+        self._pid = None
+
+    @property
+    def depth(self):
+        return self._depth
+
+    def _ensure_started(self):
+        # Потоки не переживают fork (gunicorn --preload), поэтому запускаем их лениво в каждом процессе
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queues = [queue.Queue() for _ in range(self.workers)]
+            self._depth = 0
+            for index, q in enumerate(self._queues):
+                thread = threading.Thread(target=self._worker, args=(q,), name=f"update-worker-{index}", daemon=True)
+                thread.start()
+            self._pid = os.getpid()
+            logging.info(f"Запущено {self.workers} обработчиков обновлений (глубина очереди {self.max_depth}).")
+
+    def drain(self, timeout):
+        """Ждёт, пока обработаются все поставленные обновления. False, если не успели за timeout."""
+        deadline = time.monotonic() + timeout
+        while self._depth:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def submit(self, chat_id, payload):
+        """Ставит обновление в очередь. Возвращает False, если обновление нужно отвергнуть."""
+        self._ensure_started()
+        with self._lock:
+            if self._depth >= self.max_depth:
+                if self.overflow == 'drop':
+                    self.dropped += 1
+                    logging.warning("Очередь обновлений переполнена, обновление для чата %s отброшено.", chat_id,
+                                    extra={"event": "overflow"})
+                    return True
+                self.rejected += 1
+                logging.warning("Очередь обновлений переполнена, обновление для чата %s отклонено.", chat_id,
+                                extra={"event": "overflow"})
+                return False
+            self._depth += 1
+
+        shard = hash(chat_id) % self.workers if chat_id is not None else 0
+        self._queues[shard].put(payload)
+        return True
+
+    def _worker(self, q):
+        while True:
+            payload = q.get()
+            try:
+                self.process(payload)
+            except Exception:
+                logging.error("Ошибка при обработке обновления.", exc_info=True)
+            finally:
+                with self._lock:
+                    self._depth -= 1
+                q.task_done()
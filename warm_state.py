@@ -0,0 +1,90 @@
+import logging
+import marshal
+import os
+import signal
+import sys
+import threading
+import time
+
+# Версия формата снимка состояния на диске
+SNAPSHOT_FORMAT = 1
+
+
+def write_snapshot(path, state):
+    """Атомарно записывает снимок состояния процесса (marshal)."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        marshal.dump({"format": SNAPSHOT_FORMAT, "created": time.time(), **state}, f)
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path, max_age):
+    """
+    Читает снимок и удаляет файл, чтобы после аварийного падения не
+    восстановить устаревшее состояние второй раз. Возвращает None, если
+    снимка нет, он повреждён или старше max_age секунд.
+    """
+    try:
+        with open(path, 'rb') as f:
+            state = marshal.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, ValueError, TypeError):
+        logging.warning(f"Снимок состояния '{path}' повреждён и будет пропущен.")
+        state = None
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    if not isinstance(state, dict) or state.get("format") != SNAPSHOT_FORMAT:
+        return None
+    if time.time() - state["created"] > max_age:
+        logging.info(f"Снимок состояния '{path}' устарел и будет пропущен.")
+        return None
+    return state
+
+
+class GracefulShutdown:
+    """
+    Обработчик SIGTERM: прекращает приём новых обновлений (stopping) и
+    запускает drain(timeout) в отдельном потоке. Сам обработчик сразу
+    возвращается: главный поток мог получить сигнал, держа блокировку,
+    которая нужна снимку состояния. После drain сигнал посылается
+    процессу повторно, и тогда он передаётся прежнему обработчику
+    (например, gunicorn), а если его не было — процесс завершается.
+    """
+
+    def __init__(self, drain, timeout=20):
+        self.drain = drain
+        self.timeout = timeout
+        self.stopping = False
+        self._previous = None
+        self._drained = threading.Event()
+
+    def install(self):
+        # Обработчик сигнала можно установить только из главного потока
+        if threading.current_thread() is threading.main_thread():
+            self._previous = signal.signal(signal.SIGTERM, self._handle)
+        return self
+
+    def _handle(self, signum, frame):
+        if self._drained.is_set():
+            if callable(self._previous):
+                self._previous(signum, frame)
+            elif self._previous != signal.SIG_IGN:
+                sys.exit(0)
+            return
+        if not self.stopping:
+            self.stopping = True
+            logging.info("Получен SIGTERM, завершаю обработку очередей.")
+            threading.Thread(target=self._run, args=(signum,), name="graceful-shutdown").start()
+
+    def _run(self, signum):
+        try:
+            self.drain(self.timeout)
+        except Exception:
+            logging.error("Ошибка при завершении работы.", exc_info=True)
+        finally:
+            self._drained.set()
+            # Повторный сигнал обработается в главном потоке и дойдёт до прежнего обработчика
+            os.kill(os.getpid(), signum)